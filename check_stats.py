@@ -0,0 +1,170 @@
+import sys
+import argparse
+import numpy as np
+import image_processing
+
+# the statistics as the pipeline calculated them before the vectorized kernels, column by column
+# and image by image. The kernels have to give exactly the same values, including the int()
+# truncation of the standard deviations
+
+def get_left_offset(mask):
+    offset = -1 # -1 is used where there is no character at all
+    for i in range(mask.shape[1]):
+        if mask[:, i].any():
+            offset = i
+            break
+
+    return offset
+
+def get_right_offset(mask):
+    offset = -1 # -1 is used where there is no character at all
+    for i in range(mask.shape[1]):
+        if mask[:, mask.shape[1] - 1 - i].any():
+            offset = i
+            break
+
+    return offset
+
+def get_top_offset(mask):
+    offset = -1 # -1 is used where there is no character at all
+    for i in range(mask.shape[0]):
+        if mask[i, :].any():
+            offset = i
+            break
+
+    return offset
+
+def get_bottom_offset(mask):
+    offset = -1 # -1 is used where there is no character at all
+    for i in range(mask.shape[0]):
+        if mask[mask.shape[0] - 1 - i, :].any():
+            offset = i
+            break
+
+    return offset
+
+def calculate_colors_std(image, mask):
+    if image.shape[-1] == 4:
+        image = image[..., :-1]
+    image = image[mask]
+    if image.size:
+        return np.std(image, axis=(0,))
+    else:
+        return [-1, -1, -1]
+
+def calculate_brightness(image, mask):
+    if image.shape[-1] == 4:
+        image = image[..., :-1]
+    image = image[mask]
+    if image.size:
+        return np.mean(image)
+    else:
+        return -1
+
+def reference_stats(image, stats):
+    # 'sizes' has to come before 'bbox' and 'ratios', without it the old code got the bounding box
+    # wrong
+    mask = image[..., -1] == 255
+    colors = ['Red', 'Green', 'Blue']
+    d = {}
+    for stat in stats:
+        if stat == 'resolution':
+            d['ResWidth'] = image.shape[1]
+            d['ResHeight'] = image.shape[0]
+        elif stat == 'n_pixels':
+            d['N_Pixels'] = image.shape[0] * image.shape[1]
+        elif stat == 'offsets':
+            d['LeftOffset'] = get_left_offset(mask)
+            d['RightOffset'] = get_right_offset(mask)
+            d['TopOffset'] = get_top_offset(mask)
+            d['BottomOffset'] = get_bottom_offset(mask)
+        elif stat == 'sizes':
+            d['Width'] = mask.shape[1] - get_right_offset(mask) - get_left_offset(mask)
+            d['Height'] = mask.shape[0] - get_top_offset(mask) - get_bottom_offset(mask)
+        elif stat == 'bbox':
+            d['BoundingBoxArea'] = d['Width'] * d['Height']
+        elif stat == 'char size':
+            d['CharacterSize'] = int(mask.sum(axis=(0, 1)))
+        elif stat == 'ratios':
+            n_pixels = image.shape[0] * image.shape[1]
+            char_size = int(mask.sum(axis=(0, 1)))
+            bbox_area = d['Width'] * d['Height']
+            d['SizeToImageRatio'] = char_size / n_pixels if n_pixels else -1
+            d['SizeToBoundingBoxRatio'] = char_size / bbox_area if bbox_area else -1
+        elif stat == 'variety':
+            for i, v in enumerate(calculate_colors_std(image, mask)):
+                d['Variety' + colors[i]] = int(v)
+        elif stat == 'brightness':
+            d['Brightness'] = calculate_brightness(image, mask)
+    return d
+
+STATS = ['resolution', 'n_pixels', 'offsets', 'sizes', 'bbox', 'char size', 'ratios', 'variety', 'brightness']
+MASKS = ['empty', 'full', 'random', 'box']
+
+def random_image(rng):
+    # empty and single row or column images, masks without any or with only character pixels and
+    # colors with few values, which give standard deviations that are whole numbers
+    height = int(rng.choice([0, 1, int(rng.integers(2, 40))]))
+    width = int(rng.choice([0, 1, int(rng.integers(2, 40))]))
+    image = np.zeros((height, width, 4), dtype=np.uint8)
+    if rng.random() < 0.5:
+        image[..., :3] = rng.integers(0, 256, (height, width, 3))
+    else:
+        image[..., :3] = rng.choice([0, 60, 180, 255], (height, width, 3))
+    kind = rng.choice(MASKS)
+    if kind == 'full':
+        image[..., 3] = 255
+    elif kind == 'random':
+        image[..., 3] = rng.choice([0, 128, 254, 255], (height, width))
+    elif kind == 'box' and height and width:
+        top, left = int(rng.integers(0, height)), int(rng.integers(0, width))
+        image[top: int(rng.integers(top, height)) + 1, left: int(rng.integers(left, width)) + 1, 3] = 255
+    return image
+
+def random_stats(rng):
+    # a random subset in the default order, which keeps 'sizes' before the statistics that need it
+    stats = [stat for stat in STATS if rng.random() < 0.6]
+    if 'bbox' in stats or 'ratios' in stats:
+        if 'sizes' not in stats:
+            stats.insert(stats.index('bbox' if 'bbox' in stats else 'ratios'), 'sizes')
+    return stats or ['resolution']
+
+def compare(expected, got):
+    if expected.keys() != got.keys():
+        return False
+    return all(expected[column] == got[column] for column in expected)
+
+def check(n_batches, max_batch_size, seed):
+    rng = np.random.default_rng(seed)
+    failures = 0
+    images = 0
+    for i in range(n_batches):
+        stats = STATS if i % 2 else random_stats(rng)
+        batch = [random_image(rng) for _ in range(int(rng.integers(1, max_batch_size + 1)))]
+        expected = [reference_stats(image, stats) for image in batch]
+        # single images, also as views that are not contiguous, and the padded stack of the batch
+        got = [[image_processing.calculate_image_stats(image, stats) for image in batch],
+               [image_processing.calculate_image_stats(np.asfortranarray(image), stats) for image in batch],
+               image_processing.calculate_batch_stats(*image_processing.stack_images(batch), stats)]
+        for image, expected_row, *rows in zip(batch, expected, *got):
+            images += 1
+            for name, row in zip(['image', 'view', 'batch'], rows):
+                if not compare(expected_row, row):
+                    failures += 1
+                    print('Mismatch for a {} of shape {} and {}:'.format(name, image.shape, stats))
+                    print('  expected', expected_row)
+                    print('  got     ', row)
+    return images, failures
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Compare the statistics kernels with the old per-column code')
+    parser.add_argument('--batches', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=6, help='largest batch, the sizes are random')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    images, failures = check(args.batches, args.batch_size, args.seed)
+    print('{} images, {} mismatches'.format(images, failures))
+    sys.exit(1 if failures else 0)
@@ -1,56 +1,213 @@
 import time
 import main
 import process
+import transport
 import os
+import sys
 import json
+import argparse
+import string
+import psutil
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
-def test(repeat_times=3):
-    communication_mode = ['buffers', 'files']
-    i = 0
-    times = {}
-    for mode in communication_mode:
-        cores = [0]
-        for core1 in range(len(cores) + 1):
-            cores_depth1 = cores.copy()
-            if core1 not in cores_depth1:
-                cores_depth1.append(core1)
-            for core2 in range(len(cores_depth1) + 1):
-                cores_depth2 = cores_depth1.copy()
-                if core2 not in cores_depth2:
-                    cores_depth2.append(core2)
-                for core3 in range(len(cores_depth2) + 1):
-                    cores_depth3 = cores_depth2.copy()
-                    if core3 not in cores_depth3:
-                        cores_depth3.append(core3)
-                    for scheduler_scheme in ['round_robin', 'fifo']:
-                        for _ in range(repeat_times):
-                            print('='*50)
-                            kwargs = {'communication_mode': mode,
-                                      'input_path': os.path.join('bin', 'woj'),
-                                      'proc1_core': core1,
-                                      'proc2_core': core2,
-                                      'proc3_core': core3}
-                            print(kwargs)
-                            start = time.time()
-                            processes = main.build_processes(**kwargs)
-                            if scheduler_scheme == 'round_robin':
-                                scheduler = process.Scheduler(processes, process.round_robin)
-                            else:
-                                scheduler = process.Scheduler(processes, process.fifo)
-                            scheduler.schedule()
-                            main.stop_processes(processes)
-                            t = time.time() - start
-                            if i not in times:
-                                times[i] = {'time': t,
-                                            'parameters': {**kwargs, 'scheduler_scheme': scheduler_scheme}}
-                            elif t < times[i]['time']:
-                                times[i]['time'] = t
-                        print('current_time:', times[i]['time'])
-                        i += 1
-    return times    
+SCHEMES = {**process.SCHEMES, 'free-running': None}
+
+def generate_dataset(path, n_images, seed=0):
+    # synthetic glyphs on a transparent background, every glyph is drawn in the top left quarter
+    # which is the part the pipeline crops. A dataset of the same size is generated only once
+    done_file = os.path.join(path, 'done')
+    if os.path.exists(done_file):
+        return path
+    rng = np.random.default_rng(seed)
+    characters = string.ascii_letters + string.digits
+    for i in range(n_images):
+        directory = os.path.join(path, str(i % 16))
+        os.makedirs(directory, exist_ok=True)
+        font_size = int(rng.integers(16, 96))
+        width = int(rng.integers(2, 6)) * font_size * 4 // 3
+        height = int(rng.integers(2, 6)) * font_size * 4 // 3
+        img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3)) + (255,)
+        position = (int(rng.integers(0, font_size // 3)), int(rng.integers(0, font_size // 3)))
+        ImageDraw.Draw(img).text(position, str(rng.choice(list(characters))), fill=color,
+                                 font=ImageFont.load_default(font_size))
+        img.save(os.path.join(directory, str(i) + '.png'))
+    with open(done_file, 'w') as f:
+        f.write(str(n_images))
+    return path
+
+def run_once(config, input_path, output_file, scheduler_core=0):
+    kwargs = {'communication_mode': config['communication_mode'],
+              'input_path': input_path,
+              'output_file': output_file,
+              'proc1_core': config['cores'][0],
+              'proc2_core': config['cores'][1],
+              'proc3_core': config['cores'][2],
+              'batch_size': config['batch_size'],
+              'mode': 'free-running' if config['scheme'] == 'free-running' else 'scheduled',
+              'record_timings': True}
+    if config['workers'] > 1:
+        kwargs.update({'fetcher_workers': config['workers'], 'statistics_workers': config['workers'],
+                       'fetcher_cores': config['worker_cores'], 'statistics_cores': config['worker_cores']})
+    build_start = time.time()
+    processes = main.build_processes(**kwargs)
+    if config['communication_mode'] == 'sockets':
+        transport.Coordinator(processes).schedule()
+    elif config['scheme'] == 'free-running':
+        main.join_processes(processes)
+    else:
+        scheduler = process.Scheduler(processes, SCHEMES[config['scheme']], core_nr=scheduler_core,
+                                      event_driven=config['event_driven'])
+        scheduler.schedule()
+    main.stop_processes(processes)
+
+    # the run is timed from the first task of any stage to the last one, starting the processes
+    # and the Manager is not part of it
+    stages = {}
+    for name, task_times in processes[0].timings:
+        stages.setdefault(name, []).extend(task_times)
+    starts = [start for task_times in stages.values() for start, _ in task_times]
+    ends = [end for task_times in stages.values() for _, end in task_times]
+    run_time = max(ends) - min(starts) if starts else 0.0
+    stage_times = {name: [(end - start) / config['batch_size'] for start, end in task_times]
+                   for name, task_times in stages.items()}
+    # cold start latency, from building the pipeline until the first batch is logged
+    logged = [end for _, end in stages.get('Logger', [])]
+    first_result = min(logged) - build_start if logged else 0.0
+    peak_bytes = max(proc.buffer_memory()['peak_buffer_bytes'] for proc in processes)
+    return run_time, first_result, stage_times, peak_bytes
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64)
+    if not values.size:
+        return {'median': None, 'p95': None, 'p99': None}
+    return {'median': float(np.median(values)),
+            'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99))}
+
+def benchmark(config, input_path, output_file, repeat_times=5, warmup=1, scheduler_core=0):
+    for _ in range(warmup):
+        run_once(config, input_path, output_file, scheduler_core)
+    run_times = []
+    first_results = []
+    peak_bytes = []
+    stage_times = {}
+    for _ in range(repeat_times):
+        run_time, first_result, stages, peak = run_once(config, input_path, output_file, scheduler_core)
+        run_times.append(run_time)
+        first_results.append(first_result)
+        peak_bytes.append(peak)
+        for name, times in stages.items():
+            stage_times.setdefault(name, []).extend(times)
+    median_time = float(np.median(run_times))
+    return {'config': config,
+            'run_times': run_times,
+            'run_time': summarize(run_times),
+            'image_time': summarize(np.asarray(run_times) / config['n_images']),
+            'first_result': summarize(first_results),
+            'peak_buffer_bytes': max(peak_bytes, default=0),
+            'images_per_s': config['n_images'] / median_time if median_time else None,
+            'stages': {name: summarize(times) for name, times in stage_times.items()}}
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+def sweep(communication_modes, schemes, placements, sizes, repeat_times=5, warmup=1, batch_size=1,
+          event_driven=False, worker_counts=(1,), data_path='bench_data', scheduler_core=0):
+    available = set(psutil.Process().cpu_affinity())
+    results = []
+    for n_images in sizes:
+        input_path = generate_dataset(os.path.join(data_path, str(n_images)), n_images)
+        output_file = os.path.join(data_path, 'results.csv')
+        for mode in communication_modes:
+            for scheme in schemes:
+                for cores in placements:
+                    if not set(cores) <= available:
+                        print('Skipping core placement', cores, 'not all cores available:', sorted(available))
+                        continue
+                    for workers in worker_counts:
+                        if workers > 1 and (scheme != 'free-running' or mode not in ['buffers', 'sockets']):
+                            continue # several workers per stage need free-running buffers or sockets
+                        if scheme == 'free-running' and mode == 'files':
+                            continue
+                        if scheme != 'free-running' and mode == 'sockets':
+                            continue
+                        config = {'communication_mode': mode, 'scheme': scheme, 'cores': list(cores),
+                                  'n_images': n_images, 'batch_size': batch_size, 'workers': workers,
+                                  'worker_cores': sorted(available), 'event_driven': event_driven}
+                        print('='*50)
+                        print(config)
+                        result = benchmark(config, input_path, output_file, repeat_times, warmup,
+                                           scheduler_core)
+                        print('median run time: {:.4f} s, {:.1f} images/s, first result after {:.4f} s'.format(
+                            result['run_time']['median'], result['images_per_s'], result['first_result']['median']))
+                        results.append(result)
+    return results
+
+def compare_schemes(results, reference='round_robin'):
+    # makespan of every scheme relative to the reference scheme on the same configuration
+    reference_times = {}
+    for result in results:
+        if result['config']['scheme'] == reference:
+            reference_times[config_key({**result['config'], 'scheme': None})] = result['run_time']['median']
+    for result in results:
+        reference_time = reference_times.get(config_key({**result['config'], 'scheme': None}))
+        if result['config']['scheme'] == reference or not reference_time:
+            continue
+        print('{:+.1%} makespan against {} {}'.format(result['run_time']['median'] / reference_time - 1.0,
+                                                     reference, result['config']))
+
+def compare(results, baseline, tolerance=0.1):
+    # a configuration regresses when its throughput falls more than tolerance below the baseline
+    baseline = {config_key(result['config']): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get(config_key(result['config']))
+        if old is None or not old['images_per_s'] or not result['images_per_s']:
+            continue
+        change = result['images_per_s'] / old['images_per_s'] - 1.0
+        print('{:+.1%} {:.1f} -> {:.1f} images/s {}'.format(change, old['images_per_s'],
+                                                           result['images_per_s'], result['config']))
+        if change < -tolerance:
+            regressions.append(result['config'])
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the image pipeline on synthetic glyph images')
+    parser.add_argument('--modes', nargs='+', default=['buffers', 'shm', 'files'],
+                        choices=['buffers', 'shm', 'files', 'sockets'])
+    parser.add_argument('--schemes', nargs='+', default=list(SCHEMES), choices=list(SCHEMES))
+    parser.add_argument('--placements', nargs='+', default=['0,0,0', '1,2,3'],
+                        help='cores of the fetcher, statistics and logger stages, e.g. 1,2,3')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--workers', nargs='+', type=int, default=[1])
+    parser.add_argument('--event-driven', action='store_true')
+    parser.add_argument('--fast-start', action='store_true',
+                        help='fork the stages from a preloaded fork server and reuse one Manager')
+    parser.add_argument('--scheduler-core', type=int, default=0)
+    parser.add_argument('--data', default='bench_data', help='directory for the generated datasets')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    times = test()
-    print(times)
-    with open('times.json', 'w') as f:
-        json.dump(times, f)
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    if args.fast_start:
+        main.fast_start()
+    placements = [tuple(int(core) for core in placement.split(',')) for placement in args.placements]
+    results = sweep(args.modes, args.schemes, placements, args.sizes, args.repeat, args.warmup,
+                    args.batch_size, args.event_driven, args.workers, args.data, args.scheduler_core)
+    compare_schemes(results)
+    with open(args.output, 'w') as f:
+        json.dump({'time': time.time(), 'cpu_count': os.cpu_count(), 'results': results}, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print('Regressions:', *regressions, sep='\n')
+            sys.exit(1)
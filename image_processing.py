@@ -1,41 +1,162 @@
 import numpy as np
+import math
 import json
+import io
+import csv
 from PIL import Image
 import os
+import sys
+import itertools
+import importlib.util
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import process
-import pandas as pd
+import packed_dataset
+from shared_buffer import EndOfStream
 
-def get_all_filepaths(input_path):
-    images_paths = []
-    if input_path[-1] != '/':
-        input_path += '/'
+IMAGE_EXTENSIONS = ['gif', 'png', 'jpg']
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {'dirs': {}, 'files': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    # written aside and renamed so an interrupted run keeps the previous manifest
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+def pending_manifest_path(manifest_path):
+    return manifest_path + '.pending'
+
+def commit_manifest(manifest_path):
+    # the manifest of a scan becomes the current one only after its images were logged, a run that
+    # failed or was killed leaves the previous one and its changed files are processed again
+    pending_path = pending_manifest_path(manifest_path)
+    if os.path.exists(pending_path):
+        os.replace(pending_path, manifest_path)
+
+def scan_directory(path, old_manifest=None, new_manifest=None):
+    # entries of a single directory as [name, is_dir] in the scan order. Adding, removing or
+    # renaming an entry updates the mtime of its directory, so an unmodified directory is taken
+    # from the manifest without scanning it
+    if new_manifest is None:
+        with os.scandir(path) as it:
+            return [[entry.name, entry.is_dir()] for entry in it
+                    if entry.name[-3:] in IMAGE_EXTENSIONS or entry.is_dir()]
+    mtime = os.stat(path).st_mtime_ns
+    cached = old_manifest['dirs'].get(path)
+    if cached is not None and cached[0] == mtime:
+        entries = cached[1]
+    else:
+        entries = scan_directory(path)
+    new_manifest['dirs'][path] = [mtime, entries]
+    return entries
+
+def check_file(path, old_manifest=None, new_manifest=None, only_changed=False):
+    # records the size and mtime of an image, tells whether it has to be processed
+    if new_manifest is None:
+        return True
+    known = old_manifest['files'].get(path)
+    if only_changed or known is None:
+        stat = os.stat(path)
+        record = [stat.st_size, stat.st_mtime_ns]
+    else:
+        record = known
+    new_manifest['files'][path] = record
+    return not only_changed or record != known
+
+def walk_filepaths(path, old_manifest=None, new_manifest=None, only_changed=False):
+    for name, is_dir in scan_directory(path, old_manifest, new_manifest):
+        item_path = os.path.join(path, name)
+        if is_dir:
+            yield from walk_filepaths(item_path, old_manifest, new_manifest, only_changed)
+        elif check_file(item_path, old_manifest, new_manifest, only_changed):
+            yield item_path
+
+def iter_filepaths(input_path, threads=0, manifest_path=None, only_changed=False):
+    # yields image paths as soon as they are found. With threads the top level subdirectories are
+    # walked in parallel, the paths still come in the same order as with a single thread
+    old_manifest = new_manifest = None
+    if manifest_path is not None:
+        old_manifest = load_manifest(manifest_path)
+        new_manifest = {'dirs': {}, 'files': {}}
+    elif only_changed:
+        raise AttributeError('Processing only changed files needs a manifest')
+    manifests = (old_manifest, new_manifest)
     
-    items = os.listdir(input_path)
-    for item in items:
-        extension = item[-3:]
-        if extension in ['gif', 'png', 'jpg']:
-            images_paths.append(input_path + item)
-        else:
-            # we assume that item is a directory
-            images_paths.extend(get_all_filepaths(input_path + item))
-    return images_paths
+    if not threads:
+        yield from walk_filepaths(input_path, *manifests, only_changed)
+    else:
+        with ThreadPoolExecutor(threads) as pool:
+            subtrees = []
+            for name, is_dir in scan_directory(input_path, *manifests):
+                item_path = os.path.join(input_path, name)
+                if is_dir:
+                    subtrees.append(pool.submit(list, walk_filepaths(item_path, *manifests, only_changed)))
+                else:
+                    subtrees.append(item_path)
+            for subtree in subtrees:
+                if isinstance(subtree, str):
+                    if check_file(subtree, *manifests, only_changed):
+                        yield subtree
+                else:
+                    yield from subtree.result()
+    
+    if manifest_path is not None:
+        save_manifest(new_manifest, pending_manifest_path(manifest_path))
+
+def get_all_filepaths(input_path, threads=0, manifest_path=None, only_changed=False):
+    if packed_dataset.is_packed(input_path):
+        return packed_dataset.PackedDataset(input_path).paths
+    return list(iter_filepaths(input_path, threads, manifest_path, only_changed))
 
 def change_img_on_background(img, new_background_color):
-    background_mask = img[:, :, -1] == 0
-    for channel in range(img.shape[-1] - 1):
-        img[background_mask, channel] = new_background_color[channel]
-    return img 
+    # transparent pixels get the new color, their alpha stays 0
+    background_mask = img[:, :, -1:] == 0
+    color = np.zeros(img.shape[-1], dtype=img.dtype)
+    color[:-1] = new_background_color[:img.shape[-1] - 1]
+    return np.where(background_mask, color, img)
 
-def process_image(path, background):
+def limit_decoded_rows(img, height):
+    # formats decoded row by row stop after the rows that are needed, interlaced images spread
+    # every row over the whole file so they are decoded completely
+    if img.format not in ['PNG', 'GIF'] or len(img.tile) != 1:
+        return
+    if height == 0 or height >= img.size[1]:
+        return
+    tile = img.tile[0]
+    if tuple(tile[1]) != (0, 0) + img.size:
+        return
+    if img.format == 'PNG' and img.info.get('interlace'):
+        return
+    if img.format == 'GIF' and tile[3][1]:
+        return
+    # the image keeps its size, only the rows above height are decoded into it. Depending on the
+    # Pillow version a tile is a plain tuple or a namedtuple
+    fields = (tile[0], (0, 0, img.size[0], height), *tile[2:])
+    img.tile = [type(tile)(*fields) if hasattr(tile, '_fields') else fields]
+
+def open_crop(path):
+    # only the top left quarter of the image is decoded and converted
     img = Image.open(path)
+    width = img.size[0] // 4
+    height = img.size[1] // 4
+    limit_decoded_rows(img, height)
+    return img.crop((0, 0, width, height))
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def process_image(path, background):
+    img = open_crop(path) # a path or an opened file
     img = img.convert('RGBA') # convert to RGBA format
     
-    arr = np.array(img, dtype=np.uint8)
-    # crop image
-    height = arr.shape[0] // 4
-    width = arr.shape[1] // 4
-    
-    box = arr[0: height, 0: width, :]
+    box = np.asarray(img, dtype=np.uint8)
         
     # standarize background
     if background:
@@ -43,210 +164,609 @@ def process_image(path, background):
 
     return box
 
+def pack_directory(input_path, output_path, scan_threads=0):
+    # tiles are stored without the background change so any background can be used when reading
+    tiles = ((path, process_image(path, None)) for path in iter_filepaths(input_path, scan_threads))
+    return packed_dataset.write_pack(output_path, tiles)
+
 class ImageFetcher(process.Process):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, paths=None, worker_idx=0, n_workers=1, scan_threads=0, manifest_path=None,
+                 only_changed=False, prefetch=0, **kwargs):
         super().__init__(self.process_image, *args, **kwargs)
         
-        self.paths = get_all_filepaths(self.input_path) # get all images paths
-        self.tasks_waiting.value = len(self.paths)
-        self.current_img = 0
+        self.scan = (self.input_path, scan_threads, manifest_path, only_changed)
+        self.manifest_path = manifest_path
+        self.pack = None
+        if packed_dataset.is_packed(self.input_path):
+            # a single file with the cropped images, written by pack_directory
+            self.pack = packed_dataset.PackedDataset(self.input_path)
+            paths = self.pack.paths
+        if paths is None and self.free_running and n_workers == 1:
+            # nothing needs the number of tasks up front, the fetching process scans the directory
+            # itself and sends the first batch as soon as its images are found
+            self.paths = None
+            self.batches = None
+            self.tasks_waiting.value = 1
+        else:
+            if paths is None:
+                paths = get_all_filepaths(*self.scan) # get all images paths
+            self.paths = paths
+            # one task per batch, worker number w out of n takes every n-th batch starting with batch w
+            self.batches = range(worker_idx, -(-len(self.paths) // self.batch_size), n_workers)
+            self.tasks_waiting.value = len(self.batches)
+        self.current_batch = 0
+        if self.output_path is not None:
+            # ImageStatistics finds the end of the last batch by a missing tile, so nothing may be
+            # left from a bigger dataset
+            for entry in os.scandir(self.output_path):
+                if entry.name.endswith('.npy'):
+                    os.remove(entry.path)
+        
+        # files of the next images are read by a thread pool while the current ones decode
+        self.prefetch = prefetch
+        self.upcoming = None
+        self.reads = collections.deque()
+        self.pool = None
+        
+    def worker_paths(self):
+        # paths of the images in the order this worker processes them
+        if self.batches is None:
+            yield from iter_filepaths(*self.scan)
+        else:
+            for batch_idx in self.batches:
+                first_img = batch_idx * self.batch_size
+                yield from self.paths[first_img: first_img + self.batch_size]
+                
+    def next_paths(self, n):
+        # paths of the next n images, with their contents when they are read ahead
+        if self.upcoming is None:
+            self.upcoming = self.worker_paths()
+        if not self.prefetch:
+            return list(itertools.islice(self.upcoming, n)), None
+        
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.prefetch)
+        # the reads of the next prefetch images stay in flight after taking this batch
+        while len(self.reads) < n + self.prefetch:
+            path = next(self.upcoming, None)
+            if path is None:
+                break
+            self.reads.append((path, self.pool.submit(read_file, path)))
+        reads = [self.reads.popleft() for _ in range(min(n, len(self.reads)))]
+        return [path for path, _ in reads], [future.result() for _, future in reads]
         
     def process_image(self, background=(255, 255, 255)): 
-        current_path = self.paths[self.current_img]
-        img = process_image(current_path, background)
+        if self.batches is None:
+            batch_idx = self.current_batch
+            n_images = self.batch_size
+        else:
+            batch_idx = self.batches[self.current_batch]
+            n_images = len(self.paths[batch_idx * self.batch_size: (batch_idx + 1) * self.batch_size])
+        first_img = batch_idx * self.batch_size
+        if self.pack is not None:
+            # tiles are decoded and cropped already, they are views of the mapped file
+            sources = [self.pack.tile(i) for i in range(first_img, first_img + n_images)]
+            load = lambda tile: change_img_on_background(tile, background) if background else tile
+            if self.result_cache is not None:
+                # a packed image has no file of its own, its shape and pixels are hashed instead
+                datas = [str(tile.shape).encode() + tile.tobytes() for tile in sources]
+        else:
+            batch_paths, datas = self.next_paths(n_images)
+            if self.batches is None:
+                if not batch_paths:
+                    raise EndOfStream()
+                # the number of batches is known when the scan ends, until then there is one more task
+                self.tasks_waiting.add(1)
+            if self.result_cache is not None and datas is None:
+                datas = [read_file(current_path) for current_path in batch_paths]
+            sources = batch_paths if datas is None else [io.BytesIO(data) for data in datas]
+            load = lambda source: process_image(source, background)
+            
+        if self.result_cache is None:
+            imgs = [load(source) for source in sources]
+        else:
+            # images with cached statistics are not loaded, an empty image goes in their place
+            keys = [self.result_cache.key(data) for data in datas]
+            cached = self.result_cache.contains(keys)
+            imgs = [np.zeros((0, 0, 4), dtype=np.uint8) if key in cached else load(source)
+                    for source, key in zip(sources, keys)]
+            keys = np.array([bytearray.fromhex(key) for key in keys], dtype=np.uint8)
         
         if self.output_path is not None:
-            Image.fromarray(img).save(os.path.join(self.output_path,
-                                                   str(self.current_img) + '.png'))
+            for i, img in enumerate(imgs):
+                np.save(os.path.join(self.output_path, str(first_img + i) + '.npy'), img)
         else:
-            self.output_buffer.append(img)
-        self.current_img += 1
+            item = imgs[0] if self.batch_size == 1 else stack_images(imgs)
+            if self.result_cache is not None:
+                # the keys go along with the images so the Logger can merge the cached statistics
+                item = (item, keys) if self.batch_size == 1 else (*item, keys)
+            self.push_output((batch_idx, item) if self.ordered else item)
+        self.current_batch += 1
+        
+    def clean(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        super().clean()
             
     def __repr__(self):
         return '<ImageFetcher with {} tasks>'.format(self.tasks_waiting.value)
     
-def get_left_offset(mask):
-    offset = -1 # -1 is used where there is no character at all
-    for i in range(mask.shape[1]):
-        if mask[:, i].any():
-            offset = i
-            break
-
-    return offset
-
-def get_right_offset(mask):
-    offset = -1 # -1 is used where there is no character at all
-    for i in range(mask.shape[1]):
-        if mask[:, mask.shape[1] - 1 - i].any():
-            offset = i
-            break
-
-    return offset
-
-def get_top_offset(mask):
-    offset = -1 # -1 is used where there is no character at all
-    for i in range(mask.shape[0]):
-        if mask[i, :].any():
-            offset = i
-            break
-
-    return offset
-
-def get_bottom_offset(mask):
-    offset = -1 # -1 is used where there is no character at all
-    for i in range(mask.shape[0]):
-        if mask[mask.shape[0] - 1 - i, :].any():
-            offset = i
-            break
-
-    return offset
-
-def calculate_colors_std(image, mask):
+def get_first_set(flags):
+    if not flags.size:
+        return -1 # -1 is used where there is no character at all
+    i = int(flags.argmax())
+    return i if flags[i] else -1
+
+def get_offsets(mask):
+    # one reduction per axis gives all four offsets
+    columns = mask.any(axis=0)
+    rows = mask.any(axis=1)
+    return (get_first_set(columns), get_first_set(columns[::-1]),
+            get_first_set(rows), get_first_set(rows[::-1]))
+
+def get_character_mask(image):
+    if image.shape[-1] == 4 and image.dtype == np.uint8 and image.flags.c_contiguous \
+            and sys.byteorder == 'little':
+        # alpha is the most significant byte of a little-endian RGBA word
+        return image.view(np.uint32)[..., 0] >= 0xFF000000
+    return image[..., -1] == 255
+
+def get_masked_colors(image, mask):
     if image.shape[-1] == 4:
+        if image.dtype == np.uint8 and image.flags.c_contiguous:
+            # gathering whole pixels as 32-bit words is much faster than a strided 3 byte gather
+            pixels = image.reshape(-1, 4).view(np.uint32)[mask.ravel()]
+            return pixels.view(np.uint8).reshape(-1, 4)[:, :-1]
         image = image[..., :-1]
-    image = image[mask]
-    if image.size:
-        return np.std(image, axis=(0,))
-    else:
-        return [-1, -1, -1]
+    return image[mask]
 
-def calculate_pixels_number(mask):
-    return mask.sum(axis=(0, 1))
+def get_color_histogram(image, mask):
+    colors = get_masked_colors(image, mask)
+    if colors.dtype != np.uint8:
+        raise ValueError('Color histogram needs 8-bit channels, got', colors.dtype)
+    return np.stack([np.bincount(colors[:, i], minlength=256) for i in range(colors.shape[1])])
 
-def calculate_brightness(image, mask):
-    if image.shape[-1] == 4: 
-        image = image[..., :-1]
-    image = image[mask]
-    if image.size:
-        return np.mean(image)
-    else:
+def get_histogram_moments(histogram):
+    # number of pixels and exact integer sums of the values and of their squares of every channel,
+    # a single pass over the histogram instead of the pixels
+    values = np.arange(histogram.shape[1], dtype=np.int64)
+    return int(histogram[0].sum()), histogram @ values, histogram @ (values * values)
+
+def calculate_colors_std(moments):
+    n, sums, squares = moments
+    if not n:
+        return [-1, -1, -1]
+    return [math.sqrt((n * int(sq) - int(s) * int(s)) / (n * n)) for s, sq in zip(sums, squares)]
+
+def calculate_brightness(moments):
+    n, sums, _ = moments
+    if not n:
         return -1
+    return int(sums.sum()) / (n * len(sums))
+
+def stack_images(images):
+    shapes = np.array([image.shape[:2] for image in images], dtype=np.int64).reshape(-1, 2)
+    height, width = shapes.max(axis=0) if len(images) else (0, 0)
+    # transparent padding never becomes a part of a character so it does not change statistics
+    stack = np.zeros((len(images), height, width, 4), dtype=np.uint8)
+    for i, (image, (h, w)) in enumerate(zip(images, shapes)):
+        stack[i, :h, :w] = image
+    return stack, shapes
+
+def get_batch_offsets(mask, shapes):
+    offsets = np.full((len(shapes), 4), -1, dtype=np.int64)
+    if not mask.shape[1] or not mask.shape[2]:
+        return offsets
+    columns = mask.any(axis=1)
+    rows = mask.any(axis=2)
+    found = columns.any(axis=1)
+    # offsets from the right and the bottom are measured from the edge of each image, not the padding
+    offsets[:, 0] = columns.argmax(axis=1)
+    offsets[:, 1] = shapes[:, 1] - columns.shape[1] + columns[:, ::-1].argmax(axis=1)
+    offsets[:, 2] = rows.argmax(axis=1)
+    offsets[:, 3] = shapes[:, 0] - rows.shape[1] + rows[:, ::-1].argmax(axis=1)
+    offsets[~found] = -1
+    return offsets
+
+def get_batch_color_histograms(stack, mask, char_sizes):
+    colors = get_masked_colors(stack, mask)
+    # masked pixels come out image after image so every one of them can be tagged with its image
+    bins = np.repeat(np.arange(len(stack), dtype=np.int64) * 256, char_sizes)
+    return np.stack([np.bincount(bins + colors[:, i], minlength=len(stack) * 256).reshape(-1, 256)
+                     for i in range(colors.shape[1])], axis=1)
+
+COLORS = ['Red', 'Green', 'Blue']
+
+# every statistic declares the values it is calculated from and the columns it fills, the values
+# are the image and intermediates shared by the statistics. plan_stats orders the intermediates a
+# list of statistics needs once, so each of them is calculated once per image whatever the order of
+# the list. A new statistic is registered with register_statistic and its columns added to COLUMNS,
+# a new intermediate needs a function for a single image and one for a batch of stacked images
+STATISTICS = {}
+STAT_NAMES = {}
+INTERMEDIATES = {}
+BATCH_INTERMEDIATES = {} # lists with the value of every image of the batch
+
+def register_statistic(name, inputs, columns, fun, aliases=()):
+    STATISTICS[name] = (inputs, columns, fun)
+    for alias in (name, *aliases):
+        STAT_NAMES[alias] = name
+
+def register_intermediate(name, inputs, fun, batch_inputs, batch_fun):
+    INTERMEDIATES[name] = (inputs, fun)
+    BATCH_INTERMEDIATES[name] = (batch_inputs, batch_fun)
+
+def get_character_size(mask):
+    return int(np.count_nonzero(mask))
+
+def get_character_dims(shape, offsets):
+    left, right, top, bottom = offsets
+    return shape[1] - right - left, shape[0] - top - bottom
+
+def get_character_histogram(image, mask, offsets):
+    # character pixels only occur between the top and bottom offsets, slicing rows keeps the
+    # image contiguous
+    top, bottom = offsets[2], offsets[3]
+    rows = slice(0, 0) if top == -1 else slice(top, mask.shape[0] - bottom)
+    return get_color_histogram(image[rows], mask[rows])
+
+def get_shape(mask):
+    return mask.shape
+
+def get_batch_shapes(shapes):
+    return shapes.tolist()
+
+def get_batch_offsets_list(mask, shapes):
+    return [tuple(o) for o in get_batch_offsets(mask, shapes).tolist()]
+
+def get_batch_character_sizes(mask):
+    return np.count_nonzero(mask, axis=(1, 2)).tolist()
+
+def get_batch_histogram_moments(histograms):
+    values = np.arange(histograms.shape[2], dtype=np.int64)
+    counts = histograms[:, 0].sum(axis=1).tolist()
+    return list(zip(counts, histograms @ values, histograms @ (values * values)))
+
+def get_batch_character_dims(shapes, offsets):
+    return [get_character_dims(shape, o) for shape, o in zip(shapes, offsets)]
+
+register_intermediate('mask', ['image'], get_character_mask,
+                      ['image'], get_character_mask)
+# the plans are pickled with ImageStatistics when the stages are spawned, so every function of
+# the registry has to be a module level function
+register_intermediate('shape', ['mask'], get_shape,
+                      ['shapes'], get_batch_shapes)
+register_intermediate('offsets', ['mask'], get_offsets,
+                      ['mask', 'shapes'], get_batch_offsets_list)
+register_intermediate('char_size', ['mask'], get_character_size,
+                      ['mask'], get_batch_character_sizes)
+register_intermediate('char_dims', ['shape', 'offsets'], get_character_dims,
+                      ['shape', 'offsets'], get_batch_character_dims)
+register_intermediate('histogram', ['image', 'mask', 'offsets'], get_character_histogram,
+                      ['image', 'mask', 'char_size'], get_batch_color_histograms)
+register_intermediate('moments', ['histogram'], get_histogram_moments,
+                      ['histogram'], get_batch_histogram_moments)
+
+def stat_resolution(shape):
+    return {'ResWidth': shape[1], 'ResHeight': shape[0]}
+
+def stat_n_pixels(shape):
+    return {'N_Pixels': shape[0] * shape[1]}
+
+def stat_offsets(offsets):
+    left, right, top, bottom = offsets
+    return {'LeftOffset': left, 'RightOffset': right, 'TopOffset': top, 'BottomOffset': bottom}
+
+def stat_sizes(char_dims):
+    return {'Width': char_dims[0], 'Height': char_dims[1]}
+
+def stat_bbox(char_dims):
+    return {'BoundingBoxArea': char_dims[0] * char_dims[1]}
+
+def stat_char_size(char_size):
+    return {'CharacterSize': char_size}
+
+def stat_ratios(shape, char_dims, char_size):
+    n_pixels = shape[0] * shape[1]
+    bbox_area = char_dims[0] * char_dims[1]
+    return {'SizeToImageRatio': char_size / n_pixels if n_pixels else -1,
+            'SizeToBoundingBoxRatio': char_size / bbox_area if bbox_area else -1}
+
+def stat_variety(moments):
+    return {'Variety' + color: int(v) for color, v in zip(COLORS, calculate_colors_std(moments))}
+
+def stat_brightness(moments):
+    return {'Brightness': calculate_brightness(moments)}
+
+register_statistic('resolution', ['shape'], ['ResWidth', 'ResHeight'], stat_resolution)
+register_statistic('n_pixels', ['shape'], ['N_Pixels'], stat_n_pixels)
+register_statistic('offsets', ['offsets'], ['LeftOffset', 'RightOffset', 'TopOffset', 'BottomOffset'],
+                   stat_offsets, aliases=['offset'])
+register_statistic('sizes', ['char_dims'], ['Width', 'Height'], stat_sizes, aliases=['size'])
+register_statistic('bbox', ['char_dims'], ['BoundingBoxArea'], stat_bbox, aliases=['bounding box'])
+register_statistic('char size', ['char_size'], ['CharacterSize'], stat_char_size, aliases=['character size'])
+register_statistic('ratios', ['shape', 'char_dims', 'char_size'], ['SizeToImageRatio', 'SizeToBoundingBoxRatio'],
+                   stat_ratios, aliases=['ratio'])
+register_statistic('variety', ['moments'], ['Variety' + color for color in COLORS], stat_variety,
+                   aliases=['color variety'])
+register_statistic('brightness', ['moments'], ['Brightness'], stat_brightness)
+
+def plan_stats(stats, batch=False):
+    # the intermediates in an order where every one comes after its inputs, and the inputs and
+    # function of every requested statistic
+    intermediates = BATCH_INTERMEDIATES if batch else INTERMEDIATES
+    available = {'image', 'shapes'} if batch else {'image'}
+    steps = []
+    visiting = set()
+    
+    def visit(name):
+        if name in available:
+            return
+        if name in visiting:
+            raise ValueError('Intermediates depend on each other:', name)
+        if name not in intermediates:
+            raise AttributeError('Unrecognized intermediate:', name)
+        visiting.add(name)
+        inputs, fun = intermediates[name]
+        for input_name in inputs:
+            visit(input_name)
+        steps.append((name, inputs, fun))
+        available.add(name)
+    
+    requested = []
+    for stat in stats:
+        if stat not in STAT_NAMES:
+            raise AttributeError('Unrecognized statistic:', stat)
+        if STAT_NAMES[stat] not in requested:
+            requested.append(STAT_NAMES[stat])
+    for stat in requested:
+        for input_name in STATISTICS[stat][0]:
+            visit(input_name)
+    return steps, [(STATISTICS[stat][0], STATISTICS[stat][2]) for stat in requested]
+
+def calculate_image_stats(image, plan):
+    # plan from plan_stats, a list of statistics is planned on every call
+    steps, statistics = plan_stats(plan) if isinstance(plan, list) else plan
+    values = {'image': image}
+    for name, inputs, fun in steps:
+        values[name] = fun(*[values[input_name] for input_name in inputs])
+    d = {}
+    for inputs, fun in statistics:
+        d.update(fun(*[values[input_name] for input_name in inputs]))
+    return d
+
+def calculate_batch_stats(stack, shapes, plan):
+    # plan from plan_stats with batch=True, the intermediates are calculated for the whole stack
+    steps, statistics = plan_stats(plan, batch=True) if isinstance(plan, list) else plan
+    values = {'image': stack, 'shapes': shapes}
+    for name, inputs, fun in steps:
+        values[name] = fun(*[values[input_name] for input_name in inputs])
+    records = []
+    for i in range(len(stack)):
+        d = {}
+        for inputs, fun in statistics:
+            d.update(fun(*[values[input_name][i] for input_name in inputs]))
+        records.append(d)
+    return records
+
+COLUMNS = ['Path', 'ResWidth', 'N_Pixels', 'ResHeight', 'LeftOffset', 'RightOffset',
+           'TopOffset', 'BottomOffset', 'Width', 'Height', 'BoundingBoxArea',
+           'CharacterSize', 'SizeToImageRatio', 'SizeToBoundingBoxRatio',
+           'VarietyRed', 'VarietyGreen', 'VarietyBlue', 'Brightness']
+FLOAT_COLUMNS = ['SizeToImageRatio', 'SizeToBoundingBoxRatio', 'Brightness']
+# path of the image a row was calculated from, written when only the changed images are processed
+SOURCE_COLUMN = 'Source'
+
+# in the files mode statistics are appended to a single file of fixed size records, bit i of the
+# valid field tells whether the statistic of column i was calculated
+STATS_FILE = 'stats.bin'
+STATS_DTYPE = np.dtype([('valid', np.uint32)] +
+                       [(column, np.float64 if column in FLOAT_COLUMNS else np.int64) for column in COLUMNS[1:]])
+
+def records_to_array(records):
+    array = np.zeros(len(records), dtype=STATS_DTYPE)
+    for row, record in zip(array, records):
+        valid = 0
+        for i, column in enumerate(COLUMNS[1:]):
+            if column in record:
+                row[column] = record[column]
+                valid |= 1 << i
+        row['valid'] = valid
+    return array
+
+def array_to_records(array):
+    records = []
+    for row in array:
+        record = {}
+        for i, column in enumerate(COLUMNS[1:]):
+            if int(row['valid']) >> i & 1:
+                record[column] = row[column].item()
+        records.append(record)
+    return records
 
 class ImageStatistics(process.Process):
     
-    def __init__(self, stats, *args, **kwargs):
+    def __init__(self, stats, *args, mmap_tiles=False, **kwargs):
         super().__init__(self.calculate_stats, *args, **kwargs)
         self.stats = stats
+        # the order of the intermediates is found once, not for every image
+        self.plan = plan_stats(stats)
+        self.batch_plan = plan_stats(stats, batch=True)
         self.task_counter = 0
+        self.mmap_tiles = mmap_tiles # map the tiles of the files mode instead of reading them
+        self.stats_file = None
+            
+    def get_batch_paths(self):
+        first = self.task_counter * self.batch_size
+        paths = [os.path.join(self.input_path, str(first) + '.npy')]
+        for i in range(first + 1, first + self.batch_size):
+            path = os.path.join(self.input_path, str(i) + '.npy')
+            if not os.path.exists(path):
+                break # the last batch of the dataset may be shorter
+            paths.append(path)
+        return paths
             
     def calculate_stats(self):
-        path = str(self.task_counter) + '.png'
         if self.input_buffer is not None:
-            image = self.input_buffer.pop(0)
+            paths = None
+            item = self.pop_input()
+            if self.ordered:
+                batch_idx, item = item
+            if self.result_cache is not None:
+                *item, keys = item
+                keys = [bytes(key).hex() for key in keys]
+                item = item[0] if self.batch_size == 1 else item
+            if self.batch_size == 1:
+                records = [calculate_image_stats(item, self.plan)]
+            else:
+                records = calculate_batch_stats(*item, self.batch_plan)
         else:
-            path = os.path.join(self.input_path, path)
-            image = np.array(Image.open(path))
-        
-        mask = image[..., -1] == 255
-        colors = ['Red', 'Green', 'Blue']
-        d = {}
-        
-        for stat in self.stats:
-            if stat == 'resolution':
-                d['ResWidth'] = image.shape[1]
-                d['ResHeight'] = image.shape[0]
-            elif stat == 'n_pixels':
-                d['N_Pixels'] = image.shape[0] * image.shape[1]
-            elif stat == 'offset' or stat == 'offsets':
-                d['LeftOffset'] = get_left_offset(mask)
-                d['RightOffset'] = get_right_offset(mask)
-                d['TopOffset'] = get_top_offset(mask)
-                d['BottomOffset'] = get_bottom_offset(mask)
-            elif stat == 'size' or stat == 'sizes':
-                if 'RightOffset' in d:
-                    d['Width'] = mask.shape[1] - d['RightOffset'] - d['LeftOffset']
-                    d['Height'] = mask.shape[0] - d['TopOffset'] - d['BottomOffset']     
-                else:
-                    d['Width'] = mask.shape[1] - get_right_offset(mask) - get_left_offset(mask)
-                    d['Height'] = mask.shape[0] - get_top_offset(mask) - get_bottom_offset(mask) 
-            elif stat == 'bbox' or stat == 'bounding box':
-                if 'Width' in d:
-                    d['BoundingBoxArea'] = d['Width'] * d['Height']
-                else:
-                    d['BoundingBoxArea'] = mask.shape[1] - get_right_offset(mask) - get_left_offset(mask) *\
-                        mask.shape[0] - get_top_offset(mask) - get_bottom_offset(mask) 
-            elif stat == 'character size' or stat == 'char size':
-                d['CharacterSize'] = int(calculate_pixels_number(mask))
-            elif stat == 'ratio' or stat == 'ratios':
-                n_pixels = image.shape[0] * image.shape[1]
-                if 'CharacterSize' in d:
-                    char_size = d['CharacterSize']
-                else:
-                    char_size = int(calculate_pixels_number(mask))
-                    
-                if n_pixels:
-                    d['SizeToImageRatio'] = char_size / n_pixels
-                else:
-                    d['SizeToImageRatio'] = -1
-                    
-                if 'BoundingBoxArea' in d:
-                    if d['BoundingBoxArea']:
-                        d['SizeToBoundingBoxRatio'] = char_size / d['BoundingBoxArea']
-                    else:
-                        d['SizeToBoundingBoxRatio'] = -1
-                else:
-                    
-                    if 'Width' in d:
-                        bbox_area = d['Width'] * d['Height']
-                    else:
-                        bbox_area = mask.shape[1] - get_right_offset(mask) - get_left_offset(mask) *\
-                            mask.shape[0] - get_top_offset(mask) - get_bottom_offset(mask) 
-                    if bbox_area:
-                        d['SizeToBoundingBoxRatio'] = char_size / bbox_area
-                    else:
-                        d['SizeToBoundingBoxRatio'] = -1   
-            elif stat == 'color variety' or stat == 'variety':
-                variety = calculate_colors_std(image, mask)
-                for i, v in enumerate(variety):
-                    d['Variety' + colors[i]] = int(v)
-            elif stat == 'brightness':
-                d['Brightness'] = calculate_brightness(image, mask)
+            paths = self.get_batch_paths()
+            images = [np.load(path, mmap_mode='r' if self.mmap_tiles else None) for path in paths]
+            if self.batch_size == 1:
+                records = [calculate_image_stats(images[0], self.plan)]
             else:
-                raise AttributeError('Unrecognized statistic:', stat)
-        # end for
+                records = calculate_batch_stats(*stack_images(images), self.batch_plan)
+        
         if self.output_buffer is not None:
-            self.output_buffer.append(d)
+            item = records[0] if self.batch_size == 1 else records
+            if self.result_cache is not None:
+                item = (item, keys)
+            self.push_output((batch_idx, item) if self.ordered else item)
         else:
-            new_path = os.path.join(self.output_path, str(self.task_counter) + '.json')        
-            with open(new_path, 'w') as f:
-                d = {'Path': path, 'Statistics': d}
-                json.dump(d, f)
+            if self.stats_file is None:
+                # records of an earlier run are overwritten
+                self.stats_file = open(os.path.join(self.output_path, STATS_FILE), 'wb')
+            self.stats_file.write(records_to_array(records).tobytes())
+            self.stats_file.flush()
         self.task_counter += 1
         
+    def clean(self):
+        if self.stats_file is not None:
+            self.stats_file.close()
+            self.stats_file = None
+        super().clean()
+        
 class Logger(process.Process):
-    def __init__(self, *args, verbose=False, output_path=None, **kwargs):
+    def __init__(self, *args, verbose=False, output_path=None, output_format='csv', flush_interval=1000,
+                 source_paths=None, **kwargs):
         super().__init__(self.log_results, *args, **kwargs)
+        if output_format not in ['csv', 'parquet']:
+            raise AttributeError('Output format not supported:', output_format)
+        if output_format == 'parquet':
+            # pyarrow is optional, a missing one fails the run here and not in the logging process
+            # at its first flush
+            if importlib.util.find_spec('pyarrow') is None:
+                raise ImportError('Parquet output needs pyarrow')
 
-        columns = ['Path', 'ResWidth', 'N_Pixels', 'ResHeight', 'LeftOffset', 'RightOffset',
-                   'TopOffset', 'BottomOffset', 'Width', 'Height', 'BoundingBoxArea',
-                   'CharacterSize', 'SizeToImageRatio', 'SizeToBoundingBoxRatio',
-                   'VarietyRed', 'VarietyGreen', 'VarietyBlue', 'Brightness']
-        self.df = pd.DataFrame(columns=columns)
+        self.columns = COLUMNS
+        # paths of all the images in the order of their rows, the Path column only numbers the rows
+        self.source_paths = source_paths
+        if source_paths is not None:
+            self.columns = COLUMNS + [SOURCE_COLUMN]
+        self.stats_file = None
+        # rows are kept only until the next flush, so memory does not grow with the dataset
+        self.rows = []
+        self.flush_interval = flush_interval
+        self.output_format = output_format
+        self.writer = None # opened by the logging process on its first flush
+        self.csv_writer = None
+        self.schema = None
         self.task_counter = 0
+        self.item_counter = 0
+        self.pending = {} # batches that arrived before the ones preceding them
         self.verbose = verbose
         self.output_file = output_path
         
     def log_results(self):
-        path = str(self.task_counter) + '.json'
         if self.input_buffer is not None:
-            statistics = self.input_buffer.pop(0)
+            batch = self.pop_input()
+            if self.ordered:
+                # parallel workers finish batches out of order, rows are written in dataset order
+                batch_idx, batch = batch
+                self.pending[batch_idx] = batch
+                while self.task_counter in self.pending:
+                    self.log_batch(self.pending.pop(self.task_counter))
+                return
         else:
-            path = os.path.join(self.input_path, path)
-            with open(path, 'r') as f:
-                statistics = json.load(f)['Statistics']
+            # the records of a batch are complete in the file before the Logger gets the task
+            if self.stats_file is None:
+                self.stats_file = open(os.path.join(self.input_path, STATS_FILE), 'rb')
+            data = self.stats_file.read(self.batch_size * STATS_DTYPE.itemsize)
+            batch = array_to_records(np.frombuffer(data, dtype=STATS_DTYPE))
+            batch = batch[0] if self.batch_size == 1 else batch
+        self.log_batch(batch)
+        
+    def log_batch(self, batch):
+        if self.result_cache is not None:
+            batch, keys = batch
+        if self.batch_size == 1:
+            batch = [batch]
+        if self.result_cache is not None:
+            batch = self.result_cache.merge(batch, keys)
                 
-        statistics['Path'] = path
-        if self.verbose:
-            print('Statistics:', statistics)
+        for statistics in batch:
+            path = str(self.item_counter) + '.json'
+            if self.input_buffer is None:
+                path = os.path.join(self.input_path, path)
+            statistics['Path'] = path
+            if self.source_paths is not None:
+                statistics[SOURCE_COLUMN] = self.source_paths[self.item_counter]
+            if self.verbose:
+                print('Statistics:', statistics)
+            self.item_counter += 1
         
         if self.output_file:
-            self.df = self.df.append(statistics, ignore_index=True)
+            self.rows.extend(batch)
+            if len(self.rows) >= self.flush_interval:
+                self.flush()
         self.task_counter += 1
+        
+    def open_writer(self):
+        if self.output_format == 'csv':
+            self.writer = open(self.output_file, 'w', newline='')
+            self.csv_writer = csv.writer(self.writer, lineterminator='\n')
+            self.csv_writer.writerow(self.columns)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # the same types as in the CSV and the files mode records
+            self.schema = pa.schema([(column, pa.string() if column in ['Path', SOURCE_COLUMN] else
+                                      pa.float64() if column in FLOAT_COLUMNS else pa.int64())
+                                     for column in self.columns])
+            self.writer = pq.ParquetWriter(self.output_file, self.schema)
+        
+    def csv_row(self, row):
+        # fixed types of the columns, statistics that were not calculated are left empty
+        return [('' if column not in row else
+                 float(row[column]) if column in FLOAT_COLUMNS else row[column]) for column in self.columns]
+        
+    def flush(self):
+        # writes the buffered rows as one chunk with the fixed set of columns
+        if self.writer is None:
+            self.open_writer()
+        if not self.rows:
+            return
+        rows = self.rows
+        self.rows = []
+        if self.output_format == 'csv':
+            self.csv_writer.writerows(self.csv_row(row) for row in rows)
+            self.writer.flush()
+        else:
+            import pyarrow as pa
+            # statistics that were not calculated are null
+            self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
    
     def clean(self):
         if self.output_file is not None:
-            self.df.set_index('Path', inplace=True)
-            self.df.to_csv(self.output_file)
+            self.flush()
+            self.writer.close()
+            self.writer = None
+        if self.result_cache is not None:
+            self.result_cache.close()
+        if self.stats_file is not None:
+            self.stats_file.close()
+            self.stats_file = None
         super().clean()
     
-                            
\ No newline at end of file
+                            
@@ -1,24 +1,95 @@
+import os
+import tempfile
 import process
 import image_processing
-from multiprocessing import Manager
+import shared_buffer
+import result_cache
+import transport
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import Manager, Condition
+
+# modules imported once by the fork server, every stage process starts with them already loaded
+FAST_START_MODULES = ['process', 'image_processing', 'shared_buffer', 'result_cache', 'packed_dataset']
+warm_manager = None
+
+def fast_start():
+    # stage processes are forked from a small server process instead of the whole parent, and one
+    # Manager server is kept for all the following runs. Call it once before the first run, from
+    # the main module guarded by if __name__ == '__main__'
+    global warm_manager
+    # the fork server does not get sys.path of the parent, it finds the modules through PYTHONPATH
+    package_path = os.path.dirname(os.path.abspath(__file__))
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [package_path, os.environ.get('PYTHONPATH')]))
+    multiprocessing.set_start_method('forkserver', force=True)
+    # the main module is loaded by the server as well, otherwise every stage would import it again
+    multiprocessing.set_forkserver_preload(['__main__', *FAST_START_MODULES])
+    warm_manager = Manager()
 
 def build_processes(communication_mode='buffers', input_path='bin', output_file='results.csv',
-                    proc1_core=1, proc2_core=2, proc3_core=3, verbose=False):
+                    proc1_core=1, proc2_core=2, proc3_core=3, verbose=False,
+                    shm_slots=16, shm_slot_size=4 * 1024 * 1024, batch_size=1,
+                    mode='scheduled', queue_size=16, fetcher_workers=1, statistics_workers=1,
+                    fetcher_cores=None, statistics_cores=None, output_format='csv',
+                    flush_interval=1000, scan_threads=0, manifest_path=None, only_changed=False,
+                    cache_path=None, record_timings=False, prefetch=0, mmap_tiles=False,
+                    transport_address=None, statistics_hosts=None, local_stages=None,
+                    buffer_bytes=0, spill_path=None):
+    if mode not in ['scheduled', 'free-running']:
+        raise AttributeError('Mode not supported:', mode)
+    # the stages connected by sockets run free and are started by a transport.Coordinator
+    if communication_mode == 'sockets' and mode != 'free-running':
+        raise AttributeError('Sockets communication needs the free-running mode, got:', mode)
+    if local_stages is not None and communication_mode != 'sockets':
+        raise AttributeError('Stages on other nodes need sockets communication, got:', communication_mode)
+    # without a scheduler the stages have to block on their buffers, which files cannot do
+    free_running = mode == 'free-running'
+    if free_running and communication_mode == 'files':
+        raise AttributeError('Free-running mode needs in-memory communication, got:', communication_mode)
+    # workers of a stage share its queues and the Logger restores the order of the batches
+    ordered = fetcher_workers > 1 or statistics_workers > 1
+    if ordered and not free_running:
+        raise AttributeError('Multiple workers per stage need the free-running mode, got:', mode)
+    if ordered and communication_mode not in ['buffers', 'sockets']:
+        raise AttributeError('Multiple workers per stage need buffers communication, got:',
+                             communication_mode)
+    # cached statistics travel with the images through the buffers
+    if cache_path is not None and communication_mode == 'files':
+        raise AttributeError('Result cache needs in-memory communication, got:', communication_mode)
+    fetcher_cores = fetcher_cores or [proc1_core]
+    statistics_cores = statistics_cores or [proc2_core]
     
     stats = ['resolution', 'n_pixels', 'offsets', 'sizes', 'bbox',
              'char size', 'ratios', 'variety', 'brightness']
-    manager = Manager()
-    d = manager.dict()
+    # the Manager only collects the timings, all the coordination goes through the control block
+    manager = None
+    if record_timings:
+        manager = warm_manager if warm_manager is not None else Manager()
+    n_cores = max(*fetcher_cores, *statistics_cores, proc3_core, os.cpu_count() - 1) + 1
+    control = process.ControlBlock(n_cores, fetcher_workers + statistics_workers + 1)
+    scheduler_event = Condition() # lets an event driven Scheduler sleep until some task finishes
+    cache = None
+    if cache_path is not None:
+        cache = result_cache.ResultCache(cache_path, stats)
+    common_kwargs = {'batch_size': batch_size, 'scheduler_event': scheduler_event,
+                     'free_running': free_running, 'ordered': ordered, 'result_cache': cache,
+                     'timings': manager.list() if record_timings else None}
     
-    fetcher_kwargs = {'core_nr': proc1_core}
-    fetcher_args = (d,)
+    scan_kwargs = {'scan_threads': scan_threads, 'manifest_path': manifest_path,
+                   'only_changed': only_changed, 'prefetch': prefetch}
+    fetcher_kwargs = {**scan_kwargs, **common_kwargs}
+    fetcher_args = (control,)
     
-    statistics_kwargs = {'core_nr': proc2_core}
-    statistics_args = (stats, d)
+    statistics_kwargs = {'mmap_tiles': mmap_tiles, **common_kwargs}
+    statistics_args = (stats, control)
     
-    logger_kwargs = {'verbose': verbose, 'output_path': output_file, 'core_nr': proc3_core}
-    logger_args = (d,)
+    logger_kwargs = {'verbose': verbose, 'output_path': output_file, 'core_nr': proc3_core,
+                     'output_format': output_format, 'flush_interval': flush_interval, **common_kwargs}
+    logger_args = (control,)
     
+    # endpoints and coordinator clients differ between the workers of a stage
+    fetcher_workers_kwargs = [{} for _ in range(fetcher_workers)]
+    statistics_workers_kwargs = [{} for _ in range(statistics_workers)]
     if communication_mode == 'files':
         fetcher_kwargs['input_path'] = input_path
         fetcher_kwargs['output_path'] = 'cropped'
@@ -29,44 +100,146 @@ def build_processes(communication_mode='buffers', input_path='bin', output_file=
         logger_kwargs['input_path'] = 'stats'
     elif communication_mode == 'buffers':
         fetcher_kwargs['input_path'] = input_path
-        imgs_buf = manager.list()
+        # a scheduler does not dispatch a stage while its output queue is full
+        imgs_buf = shared_buffer.BoundedQueue(queue_size, fetcher_workers, statistics_workers,
+                                              buffer_bytes, spill_path)
+        stats_buf = shared_buffer.BoundedQueue(queue_size, statistics_workers, max_bytes=buffer_bytes,
+                                               spill_path=spill_path)
+        fetcher_kwargs['output_buffer'] = imgs_buf
+        
+        statistics_kwargs['input_buffer'] = imgs_buf
+        statistics_kwargs['output_buffer'] = stats_buf
+        
+        logger_kwargs['input_buffer'] = stats_buf
+    elif communication_mode == 'shm':
+        fetcher_kwargs['input_path'] = input_path
+        imgs_buf = shared_buffer.SharedRingBuffer(shm_slots, shm_slot_size)
         fetcher_kwargs['output_buffer'] = imgs_buf
         
         statistics_kwargs['input_buffer'] = imgs_buf
-        stats_buf = manager.list()
+        stats_buf = shared_buffer.SharedRingBuffer(shm_slots, shm_slot_size)
         statistics_kwargs['output_buffer'] = stats_buf
         
         logger_kwargs['input_buffer'] = stats_buf
+    elif communication_mode == 'sockets':
+        fetcher_kwargs['input_path'] = input_path
+        if transport_address is None:
+            transport_address = 'unix:' + tempfile.mkdtemp(prefix='sczr-')
+        addresses = transport.pipeline_addresses(transport_address, statistics_workers, statistics_hosts)
+        imgs_channel = transport.SocketChannel(addresses['images'], fetcher_workers, queue_size)
+        # statistics travel as rows of the same structured array as in the files mode
+        records = (image_processing.STATS_DTYPE, image_processing.records_to_array,
+                   image_processing.array_to_records)
+        stats_channel = transport.SocketChannel(addresses['stats'], statistics_workers, queue_size, records)
+        fetcher_kwargs['output_buffer'] = imgs_channel.sender()
+        
+        for i, worker_kwargs in enumerate(statistics_workers_kwargs):
+            worker_kwargs['input_buffer'] = imgs_channel.receiver(i)
+        statistics_kwargs['output_buffer'] = stats_channel.sender()
+        
+        logger_kwargs['input_buffer'] = stats_channel.receiver(0)
+        
+        n_stages = fetcher_workers + statistics_workers + 1
+        for i, worker_kwargs in enumerate(fetcher_workers_kwargs):
+            worker_kwargs['coordinator'] = transport.CoordinatorClient(addresses['control'],
+                                                                       'ImageFetcher{}'.format(i), n_stages)
+        for i, worker_kwargs in enumerate(statistics_workers_kwargs):
+            worker_kwargs['coordinator'] = transport.CoordinatorClient(addresses['control'],
+                                                                       'ImageStatistics{}'.format(i), n_stages)
+        logger_kwargs['coordinator'] = transport.CoordinatorClient(addresses['control'], 'Logger0', n_stages)
     else:
         raise AttributeError('Communication mode not supported:', communication_mode)
     
+    # the paths are sharded between the fetchers, so they are listed only once. Only the changed
+    # images are logged with their paths, so the Logger gets the list as well
+    paths = None
+    if fetcher_workers > 1 or only_changed:
+        paths = image_processing.get_all_filepaths(input_path, scan_threads, manifest_path, only_changed)
+    if only_changed:
+        logger_kwargs['source_paths'] = paths
     logger = image_processing.Logger(*logger_args, **logger_kwargs)
-    images_stats = image_processing.ImageStatistics(*statistics_args,
-                                                    next_proc_tasks=logger.tasks_waiting,
-                                                    **statistics_kwargs)
-    images_fetcher = image_processing.ImageFetcher(*fetcher_args, 
-                                                   next_proc_tasks=images_stats.tasks_waiting,
-                                                   **fetcher_kwargs)
-    processes = [images_fetcher,
-                 images_stats,
+    images_stats = [image_processing.ImageStatistics(*statistics_args,
+                                                     next_proc_tasks=logger.tasks_waiting,
+                                                     core_nr=statistics_cores[i % len(statistics_cores)],
+                                                     **{**statistics_kwargs, **statistics_workers_kwargs[i]})
+                    for i in range(statistics_workers)]
+    images_fetchers = [image_processing.ImageFetcher(*fetcher_args, 
+                                                     next_proc_tasks=images_stats[0].tasks_waiting,
+                                                     core_nr=fetcher_cores[i % len(fetcher_cores)],
+                                                     paths=paths, worker_idx=i,
+                                                     n_workers=fetcher_workers,
+                                                     **{**fetcher_kwargs, **fetcher_workers_kwargs[i]})
+                       for i in range(fetcher_workers)]
+    processes = [*images_fetchers,
+                 *images_stats,
                  logger]
+    if local_stages is not None:
+        # only these stages run on this node, e.g. ['fetcher', 'logger'] or ['statistics:1']
+        kinds = [*['fetcher'] * fetcher_workers, *['statistics'] * statistics_workers, 'logger']
+        indices = [*range(fetcher_workers), *range(statistics_workers), 0]
+        processes = [proc for proc, kind, i in zip(processes, kinds, indices)
+                     if kind in local_stages or '{}:{}'.format(kind, i) in local_stages]
     
     for proc in processes:
         proc.start()
         
     return processes
 
+def join_processes(processes):
+    # free-running stages finish on their own once the end of the stream reaches them. After a
+    # failure the stages before the failed one could wait for space in its input forever, so all
+    # of them are stopped
+    running = {proc.process.sentinel: proc for proc in processes}
+    while running:
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            proc = running.pop(sentinel)
+            proc.process.join()
+            if proc.process.exitcode:
+                for other in running.values():
+                    other.process.terminate()
+                    other.process.join()
+                unlink_buffers(processes)
+                raise_failures(processes)
+
 def stop_processes(processes):
     for proc in processes:
         proc.stop()
         proc.process.join()
+    unlink_buffers(processes)
+    raise_failures(processes)
+    commit_manifests(processes)
+
+def commit_manifests(processes):
+    manifest_paths = {proc.manifest_path for proc in processes
+                      if isinstance(proc, image_processing.ImageFetcher) and proc.manifest_path is not None}
+    for manifest_path in manifest_paths:
+        image_processing.commit_manifest(manifest_path)
+
+def unlink_buffers(processes):
+    for proc in processes:
+        if isinstance(proc.output_buffer, shared_buffer.SharedRingBuffer):
+            proc.output_buffer.unlink()
+
+def raise_failures(processes):
+    # stages that failed on their own exit with a positive code, the ones stopped after them or
+    # killed from outside with a negative one
+    failed = [proc for proc in processes if proc.process.exitcode]
+    causes = [proc for proc in failed if proc.process.exitcode > 0] or failed
+    if causes:
+        raise RuntimeError('Pipeline stages failed: ' + ', '.join(
+            '{} (exit code {})'.format(type(proc).__name__, proc.process.exitcode) for proc in causes))
 
 if __name__ == '__main__':
     mode = 'files'
+    pipeline_mode = 'scheduled'
     input_path = 'bin'
-    processes = build_processes(communication_mode=mode, input_path=input_path, verbose=True)
+    processes = build_processes(communication_mode=mode, input_path=input_path, verbose=True,
+                                mode=pipeline_mode)
     
-    scheduler = process.Scheduler(processes, process.round_robin)
-    scheduler.schedule()
+    if pipeline_mode == 'scheduled':
+        scheduler = process.Scheduler(processes, process.round_robin, event_driven=True)
+        scheduler.schedule()
+    else:
+        join_processes(processes)
     
     stop_processes(processes)
@@ -0,0 +1,147 @@
+import threading
+import time
+import json
+import csv
+import sys
+import argparse
+import process
+import transport
+import main
+
+FIELDS = ['time', 'stage', 'core', 'tasks', 'queue_depth', 'service_time', 'mean_service_time',
+          'p50_service_time', 'p95_service_time', 'lock_wait', 'input_wait', 'output_wait', 'eta',
+          'buffer_bytes', 'peak_buffer_bytes', 'spilled_bytes']
+
+def histogram_percentile(histogram, q):
+    # upper bound of the bin holding the q-th percentile, in seconds
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    count = 0
+    for i, bin_count in enumerate(histogram):
+        count += bin_count
+        if count >= q * total:
+            return 2 ** i / 1e6
+    return 2 ** (len(histogram) - 1) / 1e6
+
+def stage_names(processes):
+    # several workers of one stage are told apart by their index
+    counts = {}
+    names = []
+    for proc in processes:
+        name = type(proc).__name__
+        names.append('{}{}'.format(name, counts.get(name, 0)))
+        counts[name] = counts.get(name, 0) + 1
+    return names
+
+def snapshot(processes):
+    now = time.time()
+    rows = []
+    for name, proc in zip(stage_names(processes), processes):
+        metrics = proc.read_metrics()
+        tasks = metrics['tasks']
+        rows.append({'time': now,
+                     'stage': name,
+                     'core': proc.core_nr.value,
+                     'tasks': tasks,
+                     'queue_depth': metrics['queue_depth'],
+                     'service_time': metrics['service_time'],
+                     'mean_service_time': metrics['service_time'] / tasks if tasks else 0.0,
+                     'p50_service_time': histogram_percentile(metrics['histogram'], 0.5),
+                     'p95_service_time': histogram_percentile(metrics['histogram'], 0.95),
+                     'lock_wait': metrics['lock_wait'],
+                     'input_wait': metrics['input_wait'],
+                     'output_wait': metrics['output_wait'],
+                     'eta': metrics['eta'],
+                     'buffer_bytes': metrics['buffer_bytes'],
+                     'peak_buffer_bytes': metrics['peak_buffer_bytes'],
+                     'spilled_bytes': metrics['spilled_bytes']})
+    return rows
+
+def print_rows(rows):
+    print('{:<18}{:>8}{:>8}{:>12}{:>12}{:>12}{:>12}{:>12}{:>12}'.format('stage', 'tasks', 'queue', 'mean [ms]',
+                                                                        'p95 [ms]', 'lock [s]', 'input [s]',
+                                                                        'output [s]', 'peak [MB]'))
+    for row in rows:
+        print('{:<18}{:>8}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+            row['stage'], row['tasks'], row['queue_depth'], row['mean_service_time'] * 1e3,
+            row['p95_service_time'] * 1e3, row['lock_wait'], row['input_wait'], row['output_wait'],
+            row['peak_buffer_bytes'] / 2 ** 20))
+
+class Monitor:
+    # reads the metrics of the stages from shared memory in a thread of the parent process, so it
+    # works while Scheduler.schedule runs. Snapshots are appended to a CSV file or, for any other
+    # extension, to a file with one JSON object per line, or printed when there is no file
+    def __init__(self, processes, interval=1.0, output_path=None):
+        self.processes = processes
+        self.interval = interval
+        self.output_path = output_path
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def dump(self, rows, f, writer):
+        if f is None:
+            print_rows(rows)
+        elif writer is not None:
+            writer.writerows(rows)
+            f.flush()
+        else:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+            f.flush()
+
+    def run(self):
+        f = writer = None
+        if self.output_path is not None:
+            f = open(self.output_path, 'w', newline='')
+            if self.output_path.endswith('.csv'):
+                writer = csv.DictWriter(f, FIELDS)
+                writer.writeheader()
+        while not self.stopped.wait(self.interval):
+            self.dump(snapshot(self.processes), f, writer)
+        # the final state after the stages finished
+        self.dump(snapshot(self.processes), f, writer)
+        if f is not None:
+            f.close()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run the pipeline and watch its stages')
+    parser.add_argument('--input', default='bin')
+    parser.add_argument('--mode', default='buffers', choices=['buffers', 'shm', 'files', 'sockets'])
+    parser.add_argument('--scheme', default='round_robin', choices=[*process.SCHEMES, 'free-running'])
+    parser.add_argument('--cores', default='1,2,3', help='cores of the fetcher, statistics and logger stages')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--buffer-bytes', type=int, default=0,
+                        help='memory limit of every buffers mode queue, 0 for no limit')
+    parser.add_argument('--spill', help='directory for the items over the memory limit, without it the '
+                                        'producers wait')
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--output', help='CSV or JSON lines file for the snapshots, printed when not given')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    cores = [int(core) for core in args.cores.split(',')]
+    free_running = args.scheme == 'free-running'
+    processes = main.build_processes(communication_mode=args.mode, input_path=args.input,
+                                     proc1_core=cores[0], proc2_core=cores[1], proc3_core=cores[2],
+                                     batch_size=args.batch_size, buffer_bytes=args.buffer_bytes,
+                                     spill_path=args.spill,
+                                     mode='free-running' if free_running else 'scheduled')
+    monitor = Monitor(processes, args.interval, args.output)
+    monitor.start()
+    if args.mode == 'sockets':
+        transport.Coordinator(processes).schedule()
+    elif free_running:
+        main.join_processes(processes)
+    else:
+        process.Scheduler(processes, process.SCHEMES[args.scheme], event_driven=True).schedule()
+    main.stop_processes(processes)
+    monitor.stop()
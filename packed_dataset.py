@@ -0,0 +1,80 @@
+import sys
+import json
+import numpy as np
+
+# a packed dataset is a single file with a header, the cropped RGBA tiles of all images one after
+# another, an index with the offset, height and width of every tile and the original paths as JSON.
+# header: magic, number of images, offset of the index, offset of the paths, size of the paths
+MAGIC = b'SCZRPACK'
+HEADER_SIZE = 64
+ALIGNMENT = 64
+INDEX_FIELDS = 3
+
+def is_packed(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IsADirectoryError, FileNotFoundError):
+        return False
+
+def write_pack(output_path, tiles):
+    # tiles is an iterable of (path, RGBA image), they are written one by one
+    paths = []
+    index = []
+    with open(output_path, 'wb') as f:
+        f.write(bytes(HEADER_SIZE))
+        for path, tile in tiles:
+            offset = -(-f.tell() // ALIGNMENT) * ALIGNMENT
+            f.write(bytes(offset - f.tell()))
+            f.write(np.ascontiguousarray(tile).tobytes())
+            paths.append(path)
+            index.append((offset, tile.shape[0], tile.shape[1]))
+
+        index_offset = -(-f.tell() // ALIGNMENT) * ALIGNMENT
+        f.write(bytes(index_offset - f.tell()))
+        f.write(np.array(index, dtype=np.int64).reshape(-1, INDEX_FIELDS).tobytes())
+        paths_offset = f.tell()
+        paths_data = json.dumps(paths).encode()
+        f.write(paths_data)
+
+        f.seek(0)
+        f.write(MAGIC)
+        f.write(np.array([len(paths), index_offset, paths_offset, len(paths_data)], dtype=np.int64).tobytes())
+    return len(paths)
+
+class PackedDataset:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            if header[:len(MAGIC)] != MAGIC:
+                raise ValueError('Not a packed dataset:', path)
+            self.n_images, self.index_offset, paths_offset, paths_size = \
+                (int(value) for value in np.frombuffer(header, dtype=np.int64, count=4, offset=len(MAGIC)))
+            f.seek(paths_offset)
+            self.paths = json.loads(f.read(paths_size).decode())
+        self.data = None # mapped by the process that reads the tiles
+        self.index = None
+
+    def map(self):
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+            self.index = np.ndarray((self.n_images, INDEX_FIELDS), dtype=np.int64, buffer=self.data,
+                                    offset=self.index_offset)
+
+    def __len__(self):
+        return self.n_images
+
+    def tile(self, i):
+        # a read-only view of the mapped file, nothing is copied
+        self.map()
+        offset, height, width = (int(value) for value in self.index[i])
+        return np.ndarray((height, width, 4), dtype=np.uint8, buffer=self.data, offset=offset)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python packed_dataset.py <input directory> <output file>')
+        sys.exit(1)
+    import image_processing
+    n_images = image_processing.pack_directory(sys.argv[1], sys.argv[2])
+    print('Packed', n_images, 'images into', sys.argv[2])
@@ -3,46 +3,149 @@ import time
 import psutil
 from ctypes import c_bool
 import os
+from shared_buffer import EndOfStream
 
 current_process_idx = 0
 
+# layout of the metrics a stage exports in shared memory, only the stage itself writes them
+METRIC_TASKS = 0
+METRIC_SERVICE_TIME = 1
+METRIC_LOCK_WAIT = 2 # waiting for the scheduler to release the stage
+METRIC_INPUT_WAIT = 3 # waiting for an item in the input buffer
+METRIC_OUTPUT_WAIT = 4 # appending to the output buffer, which blocks while it is full
+METRIC_ETA = 5
+METRIC_LAST_WORKED = 6
+METRIC_INPUT_DEPTH = 7 # items in the input buffer after the last pop, for buffers only the stage can count
+HISTOGRAM_START = 8
+# bin i counts tasks that took less than 2**i microseconds and at least half of that, the last
+# bin counts all the longer ones
+HISTOGRAM_BINS = 24
+METRIC_FIELDS = HISTOGRAM_START + HISTOGRAM_BINS
+
+# seconds an event driven Scheduler waits before checking if a stage failed
+FAILURE_CHECK_INTERVAL = 0.5
+
+# scheduling schemes make a single non-blocking pass over the processes and return None instead of
+# a process when none of them can run right now, it is up to the Scheduler how to wait for a change.
+# lock2 of a process is held from its dispatch until it takes the task, a process whose lock2 is
+# taken is not ready yet
+
 def round_robin(processes, current_process_idx):
-    while True:
-        proc_chosen = processes[current_process_idx]
-        
-        proc_chosen.lock2.acquire()
-        if proc_chosen.tasks_waiting.value and not proc_chosen.is_busy():
-            #print(proc_chosen, 'scheduled')
-            break
-        proc_chosen.lock2.release()
-        
-    current_process_idx = (current_process_idx + 1) % len(processes)   
-    return current_process_idx, proc_chosen
+    proc_chosen = processes[current_process_idx]
+    
+    if not proc_chosen.lock2.acquire(block=False):
+        return current_process_idx, None
+    if proc_chosen.tasks_waiting.value and not proc_chosen.is_busy():
+        #print(proc_chosen, 'scheduled')
+        current_process_idx = (current_process_idx + 1) % len(processes)
+        return current_process_idx, proc_chosen
+    proc_chosen.lock2.release()
+    
+    return current_process_idx, None
 
 def fifo(processes, current_process_idx):
-    while True:
+    for _ in range(len(processes)):
         proc_chosen = processes[current_process_idx]
         
-        proc_chosen.lock2.acquire()
-        if not proc_chosen.tasks_waiting.value:
-            current_process_idx = (current_process_idx + 1) % len(processes)
-        elif not proc_chosen.is_busy():
-            #print(proc_chosen, 'scheduled')
-            break
+        if not proc_chosen.lock2.acquire(block=False):
+            return current_process_idx, None
+        if proc_chosen.tasks_waiting.value:
+            if proc_chosen.is_busy():
+                # the oldest stage with work is still running, wait for it
+                proc_chosen.lock2.release()
+                return current_process_idx, None
+            if not proc_chosen.is_blocked():
+                #print(proc_chosen, 'scheduled')
+                return current_process_idx, proc_chosen
+            # output buffer is full, let the next stages drain it first
         proc_chosen.lock2.release()
+        current_process_idx = (current_process_idx + 1) % len(processes)
          
-    return current_process_idx, proc_chosen
+    return current_process_idx, None
+
+def ready_processes(processes):
+    # takes lock2 of every process that can run right now, the caller releases the ones it does
+    # not choose
+    ready = []
+    for proc in processes:
+        if not proc.lock2.acquire(block=False):
+            continue
+        if proc.tasks_waiting.value and not proc.is_busy() and not proc.is_blocked():
+            ready.append(proc)
+        else:
+            proc.lock2.release()
+    return ready
+
+def choose_process(processes, current_process_idx, key):
+    ready = ready_processes(processes)
+    if not ready:
+        return current_process_idx, None
+    proc_chosen = min(ready, key=key)
+    for proc in ready:
+        if proc is not proc_chosen:
+            proc.lock2.release()
+    return processes.index(proc_chosen), proc_chosen
+
+def shortest_job_first(processes, current_process_idx):
+    # a stage that has not run yet has no eta and goes first so its eta gets known
+    return choose_process(processes, current_process_idx, lambda proc: proc.get_eta())
+
+def largest_backlog_first(processes, current_process_idx):
+    return choose_process(processes, current_process_idx, lambda proc: -proc.tasks_waiting.value)
+
+def minimum_latency(processes, current_process_idx):
+    # shortest remaining time of an item: the stages are in the order of the pipeline, so an item
+    # waiting for a stage still needs that stage and all the following ones. Items closest to
+    # being logged go first, which keeps as few of them in flight as possible
+    etas = [proc.get_eta() for proc in processes]
+    remaining = {proc: (sum(etas[i:]), -i) for i, proc in enumerate(processes)}
+    return choose_process(processes, current_process_idx, lambda proc: remaining[proc])
+
+SCHEMES = {'round_robin': round_robin, 'fifo': fifo, 'shortest_job_first': shortest_job_first,
+           'largest_backlog_first': largest_backlog_first, 'minimum_latency': minimum_latency}
 
 class Scheduler:
-    def __init__(self, processes, scheduling_scheme, core_nr=0):
+    def __init__(self, processes, scheduling_scheme, core_nr=0, event_driven=False):
         self.processes = processes
         self.scheduling_scheme = scheduling_scheme
         self.core_nr = core_nr
         self.current_process_idx = 0
+        self.event_driven = event_driven
+        if event_driven and processes[0].scheduler_event is None:
+            raise AttributeError('Event driven scheduling needs processes created with a scheduler_event')
         
     def change_scheduling_scheme(self, scheduling_scheme):
         self.scheduling_scheme = scheduling_scheme
         
+    def failed(self):
+        # a stage that failed never finishes its task, stop_processes reports it
+        return any(process.process.exitcode for process in self.processes)
+        
+    def next_process(self):
+        if not self.event_driven:
+            # busy wait, keeps the scheduler core fully loaded
+            while True:
+                self.current_process_idx, next_process = self.scheduling_scheme(self.processes,
+                                                                                self.current_process_idx)
+                if next_process is not None:
+                    return next_process
+                if self.failed():
+                    return None
+        
+        # every process notifies the event after finishing a task, which is the only moment
+        # when a process can become ready to run
+        event = self.processes[0].scheduler_event
+        with event:
+            while True:
+                self.current_process_idx, next_process = self.scheduling_scheme(self.processes,
+                                                                                self.current_process_idx)
+                if next_process is not None:
+                    return next_process
+                # a failed stage does not notify, so the wait is limited
+                if self.failed():
+                    return None
+                event.wait(FAILURE_CHECK_INTERVAL)
+        
     def schedule(self):
         p = psutil.Process()
         p.cpu_affinity([self.core_nr])
@@ -52,18 +155,72 @@ class Scheduler:
         tasks *= len(self.processes) # the first process produces task for second process and the second produces task for third so there are 3 tasks per every inital one
         #print('tasks:', tasks)
         while tasks > 0:
-            self.current_process_idx, next_process = self.scheduling_scheme(self.processes, self.current_process_idx)
+            next_process = self.next_process()
+            if next_process is None:
+                return
             
             next_process.cores_status_running[next_process.core_nr.value] = True
             next_process.release()
             tasks -= 1
             
+class SharedField:
+    # one integer of a control block. Reads and plain writes go straight to shared memory, the
+    # read-modify-write updates take the lock of the whole block
+    def __init__(self, fields, index, lock):
+        self.fields = fields
+        self.index = index
+        self.lock = lock
+        
+    @property
+    def value(self):
+        return self.fields[self.index]
+    
+    @value.setter
+    def value(self, value):
+        self.fields[self.index] = value
+        
+    def add(self, delta):
+        with self.lock:
+            self.fields[self.index] += delta
+            
+class ControlBlock:
+    # the coordination state of the whole pipeline in shared memory: whether each core runs a task
+    # and the task counter and running and terminated flags of each stage. Only the counters are
+    # updated under the lock, which is a futex in shared memory so nothing goes through a Manager
+    STAGE_FIELDS = 3
+    
+    def __init__(self, n_cores, n_stages):
+        self.lock = multiprocessing.Lock()
+        self.busy = multiprocessing.RawArray(c_bool, n_cores)
+        self.fields = multiprocessing.RawArray('q', n_stages * self.STAGE_FIELDS)
+        self.n_stages = n_stages
+        self.allocated = 0
+        
+    def add_stage(self):
+        # tasks waiting, running and terminated of the next stage
+        if self.allocated == self.n_stages:
+            raise ValueError('Control block has fields for only', self.n_stages, 'stages')
+        first = self.allocated * self.STAGE_FIELDS
+        self.allocated += 1
+        return [SharedField(self.fields, first + i, self.lock) for i in range(self.STAGE_FIELDS)]
+    
 class Process:
-    def __init__(self, fun, cores_status_running, input_buffer=None, input_path=None,
+    def __init__(self, fun, control, input_buffer=None, input_path=None,
                  output_buffer=None, output_path=None, next_proc_tasks=None,
-                 core_nr=0, p=0.1):
+                 core_nr=0, p=0.1, batch_size=1, scheduler_event=None, free_running=False,
+                 ordered=False, result_cache=None, timings=None, coordinator=None):
         self.p = p
-        self.running = multiprocessing.Value(c_bool, True)
+        self.batch_size = batch_size
+        self.ordered = ordered # buffer items carry the index of their batch
+        self.free_running = free_running
+        self.result_cache = result_cache # statistics of already processed images
+        self.timings = timings # list shared with the parent, gets the times of all tasks when the stage ends
+        self.coordinator = coordinator # starts the free-running stages of the sockets mode together
+        self.task_times = []
+        self.metrics = multiprocessing.RawArray('d', METRIC_FIELDS)
+        self.scheduler_event = scheduler_event
+        self.tasks_waiting, self.running, self.terminated = control.add_stage()
+        self.running.value = True
         
         self.lock = multiprocessing.Lock()
         self.lock.acquire()
@@ -71,14 +228,12 @@ class Process:
 
         self.last_worked = time.time()
         self.eta = 0.0
-        self.tasks_waiting = multiprocessing.Value('i', 0)
-        self.terminated = multiprocessing.Value(c_bool, False)
         self.next_proc_tasks = next_proc_tasks
         
-        if core_nr not in cores_status_running:
-            cores_status_running[core_nr] = False
-        self.core_nr = multiprocessing.Value('i', core_nr)
-        self.cores_status_running = cores_status_running
+        if core_nr >= len(control.busy):
+            raise ValueError('Control block has no field for core', core_nr)
+        self.core_nr = multiprocessing.RawValue('i', core_nr)
+        self.cores_status_running = control.busy
         
         if input_buffer is not None:
             self.input_buffer = input_buffer
@@ -95,8 +250,12 @@ class Process:
             if not os.path.exists(output_path):
                 os.makedirs(output_path)
             self.output_buffer = None
-            
-        self.process = multiprocessing.Process(target=self.do_work, args=(fun,))
+        else:
+            self.output_path = None
+            self.output_buffer = None
+
+        target = self.free_run if free_running else self.do_work
+        self.process = multiprocessing.Process(target=target, args=(fun,))
     
     def do_work(self, fun):
         p = psutil.Process()
@@ -105,32 +264,131 @@ class Process:
         
         while True:
             #print(self, 'before wait')
+            start = time.time()
             self.wait()
+            self.metrics[METRIC_LOCK_WAIT] += time.time() - start
             #print(self, 'after wait')
             if not self.running.value:
+                self.report_timings()
                 self.terminated.value = True
                 self.clean()
                 return
             
-            self.tasks_waiting.value -= 1
+            self.tasks_waiting.add(-1)
             self.lock2.release()
                 
-            start = time.time()
-            fun()
+            self.run_task(fun)
             if self.next_proc_tasks is not None:
-                self.next_proc_tasks.value += 1
-            self.last_worked = time.time()
-            
-            temp = self.last_worked - start
-            if not self.eta:
-                self.eta = temp
-            else:
-                self.eta = (1.0 - self.p) * self.eta + self.p * temp
+                self.next_proc_tasks.add(1)
                 
             self.cores_status_running[self.core_nr.value] = False
+            if self.scheduler_event is not None:
+                with self.scheduler_event:
+                    self.scheduler_event.notify()
+            
+    def free_run(self, fun):
+        # no scheduler, the stage runs as fast as its input and output buffers allow
+        p = psutil.Process()
+        p.cpu_affinity([self.core_nr.value])
+        if self.coordinator is not None:
+            self.coordinator.register(self)
+        
+        try:
+            if self.input_buffer is None:
+                # the first stage produces its own tasks
+                while self.running.value and self.tasks_waiting.value:
+                    self.tasks_waiting.add(-1)
+                    self.run_task(fun)
+            else:
+                while self.running.value:
+                    self.run_task(fun)
+        except EndOfStream:
+            pass
+        finally:
+            # a failed stage still ends the stream, otherwise the next stages would wait for it forever
+            if self.output_buffer is not None:
+                self.output_buffer.finish()
+            self.clean()
+            self.report_timings()
+            if self.coordinator is not None:
+                self.coordinator.report(self)
+            self.terminated.value = True
+        
+    def run_task(self, fun):
+        start = time.time()
+        fun()
+        self.last_worked = time.time()
+        if self.timings is not None:
+            self.task_times.append((start, self.last_worked))
+        
+        temp = self.last_worked - start
+        if not self.eta:
+            self.eta = temp
+        else:
+            self.eta = (1.0 - self.p) * self.eta + self.p * temp
+            
+        self.metrics[METRIC_TASKS] += 1
+        self.metrics[METRIC_SERVICE_TIME] += temp
+        self.metrics[HISTOGRAM_START + min(int(temp * 1e6).bit_length(), HISTOGRAM_BINS - 1)] += 1
+        self.metrics[METRIC_ETA] = self.eta
+        self.metrics[METRIC_LAST_WORKED] = self.last_worked
+        
+    def pop_input(self):
+        start = time.time()
+        item = self.input_buffer.pop(0)
+        self.metrics[METRIC_INPUT_WAIT] += time.time() - start
+        if getattr(self.input_buffer, 'counted_by_stage', False):
+            self.metrics[METRIC_INPUT_DEPTH] = len(self.input_buffer)
+        return item
+    
+    def push_output(self, item):
+        start = time.time()
+        self.output_buffer.append(item)
+        self.metrics[METRIC_OUTPUT_WAIT] += time.time() - start
+            
+    def get_eta(self):
+        # the eta of the stage as seen from the other processes
+        return self.metrics[METRIC_ETA]
+    
+    def queue_depth(self):
+        # scheduled stages count their tasks, free-running ones only have their input buffer
+        if self.free_running and self.input_buffer is not None:
+            if getattr(self.input_buffer, 'counted_by_stage', False):
+                return int(self.metrics[METRIC_INPUT_DEPTH])
+            return len(self.input_buffer)
+        return self.tasks_waiting.value
+    
+    def read_metrics(self):
+        metrics = list(self.metrics)
+        return {'tasks': int(metrics[METRIC_TASKS]),
+                'service_time': metrics[METRIC_SERVICE_TIME],
+                'lock_wait': metrics[METRIC_LOCK_WAIT],
+                'input_wait': metrics[METRIC_INPUT_WAIT],
+                'output_wait': metrics[METRIC_OUTPUT_WAIT],
+                'eta': metrics[METRIC_ETA],
+                'last_worked': metrics[METRIC_LAST_WORKED],
+                'queue_depth': self.queue_depth(),
+                **self.buffer_memory(),
+                'histogram': [int(count) for count in metrics[HISTOGRAM_START:]]}
+        
+    def buffer_memory(self):
+        # memory taken by the items in the output buffer, for the buffers that count it
+        memory = getattr(self.output_buffer, 'memory', None)
+        if memory is None:
+            return {'buffer_bytes': 0, 'peak_buffer_bytes': 0, 'spilled_bytes': 0}
+        return memory()
+        
+    def report_timings(self):
+        if self.timings is not None:
+            self.timings.append((type(self).__name__, self.task_times))
             
     def is_busy(self):
         return self.cores_status_running[self.core_nr.value]
+    
+    def is_blocked(self):
+        # a stage writing to a bounded buffer (shared memory ring) cannot run while it is full
+        full = getattr(self.output_buffer, 'full', None)
+        return full is not None and full()
             
     def wait(self):
         self.lock.acquire()
@@ -144,7 +402,8 @@ class Process:
     def stop(self):
         self.running.value = False
         i = False
-        while not self.terminated.value:
+        # a stage that failed never sets terminated
+        while not self.terminated.value and self.process.is_alive():
             try:
                 self.release()
             except ValueError:
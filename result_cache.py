@@ -0,0 +1,66 @@
+import sqlite3
+import hashlib
+import json
+
+class ResultCache:
+    # statistics of already processed images stored in SQLite under the hash of the image file,
+    # the requested statistics and the background colour are part of the hash as well so changing
+    # either of them does not return stale results
+    def __init__(self, path, stats, background=(255, 255, 255)):
+        self.path = path
+        self.stats = list(stats)
+        self.background = tuple(background)
+        self.params = json.dumps([self.stats, self.background]).encode()
+        self.connection = None # every process opens its own connection on the first use
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            # readers in the fetching processes do not block the Logger writing new results
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, stats TEXT)')
+            self.connection.commit()
+        return self.connection
+
+    def key(self, data):
+        return hashlib.blake2b(self.params + data, digest_size=16).hexdigest()
+
+    def query(self, keys, columns):
+        keys = list(set(keys))
+        rows = []
+        for i in range(0, len(keys), 500): # SQLite limits the number of query parameters
+            chunk = keys[i: i + 500]
+            rows.extend(self.connect().execute(
+                'SELECT {} FROM results WHERE key IN ({})'.format(columns, ','.join('?' * len(chunk))),
+                chunk))
+        return rows
+
+    def contains(self, keys):
+        return {row[0] for row in self.query(keys, 'key')}
+
+    def get(self, keys):
+        return {key: json.loads(stats) for key, stats in self.query(keys, 'key, stats')}
+
+    def merge(self, records, keys):
+        # takes the cached statistics where there are any and stores the newly calculated ones
+        cached = self.get(keys)
+        new = []
+        merged = []
+        for record, key in zip(records, keys):
+            if key in cached:
+                merged.append(dict(cached[key])) # the Logger adds the path to every record
+            else:
+                new.append((key, json.dumps(record)))
+                cached[key] = record
+                merged.append(record)
+        if new:
+            connection = self.connect()
+            connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?)', new)
+            connection.commit()
+        return merged
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
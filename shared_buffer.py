@@ -0,0 +1,296 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import sys
+import json
+import pickle
+import numpy as np
+
+# header of a single slot: sequence number, kind of the payload, number of arrays, whether the
+# payload is in an overflow segment instead of the slot and for each of up to MAX_ARRAYS arrays its
+# offset in the slot, size in bytes, dtype character, number of dimensions and up to MAX_DIMS
+# dimensions
+MAX_ARRAYS = 4
+MAX_DIMS = 4
+ARRAY_FIELDS = 4 + MAX_DIMS
+ARRAYS_START = 4
+HEADER_FIELDS = ARRAYS_START + MAX_ARRAYS * ARRAY_FIELDS
+ALIGNMENT = 64
+KIND_ARRAY = 0
+KIND_JSON = 1
+KIND_TUPLE = 2
+KIND_END = 3
+
+# memory counters of a bounded queue
+QUEUE_BYTES = 0
+QUEUE_PEAK_BYTES = 1
+QUEUE_SPILLED_BYTES = 2
+# queued by the consumer that saw the end of every producer, ends the stream for the other ones
+STOP = 'stop'
+
+class EndOfStream(Exception):
+    pass
+
+def item_nbytes(item):
+    # memory of the arrays in an item, anything else is counted by its size as an object
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if isinstance(item, (tuple, list)):
+        return sum(item_nbytes(value) for value in item)
+    if isinstance(item, dict):
+        return sys.getsizeof(item) + sum(item_nbytes(value) for value in item.values())
+    return sys.getsizeof(item)
+
+class BoundedQueue:
+    # blocking FIFO with the list interface used by the stages, None marks the end of the stream.
+    # any number of workers can write to and read from it. Every producer queues an end marker
+    # behind its own items, the consumer that takes the last of them has seen the whole stream
+    # and stops the other consumers.
+    # Besides maxsize items, max_bytes (0 for no limit) bounds the memory of the queued items: a
+    # producer waits while they take max_bytes or more, so the queue never holds more than
+    # max_bytes and one item. With a spill_path the items over the limit are written there instead
+    # of waiting and only their file names are queued
+    def __init__(self, maxsize=16, producers=1, consumers=1, max_bytes=0, spill_path=None):
+        self.queue = multiprocessing.Queue(maxsize)
+        self.producers = producers
+        self.consumers = consumers
+        self.finished = multiprocessing.Value('i', 0)
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        if spill_path is not None:
+            os.makedirs(spill_path, exist_ok=True)
+        self.spilled = 0 # files written by this producer
+        self.memory_changed = multiprocessing.Condition()
+        self.counters = multiprocessing.RawArray('q', 3)
+
+    def append(self, item):
+        nbytes = item_nbytes(item)
+        spill = False
+        with self.memory_changed:
+            while self.max_bytes and self.counters[QUEUE_BYTES] >= self.max_bytes:
+                if self.spill_path is not None:
+                    spill = True
+                    break
+                self.memory_changed.wait()
+            if spill:
+                self.counters[QUEUE_SPILLED_BYTES] += nbytes
+            else:
+                self.counters[QUEUE_BYTES] += nbytes
+                self.counters[QUEUE_PEAK_BYTES] = max(self.counters[QUEUE_PEAK_BYTES],
+                                                      self.counters[QUEUE_BYTES])
+        if spill:
+            path = os.path.join(self.spill_path, '{}-{}.pickle'.format(os.getpid(), self.spilled))
+            self.spilled += 1
+            with open(path, 'wb') as f:
+                pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.queue.put((None, path))
+        else:
+            self.queue.put((nbytes, item))
+
+    def pop(self, index=0):
+        if index != 0:
+            raise IndexError('Bounded queue can only pop the oldest item')
+        entry = self.queue.get()
+        while entry is None:
+            with self.finished.get_lock():
+                self.finished.value += 1
+                last = self.finished.value == self.producers
+            if last:
+                for _ in range(self.consumers - 1):
+                    self.queue.put(STOP)
+                raise EndOfStream()
+            entry = self.queue.get()
+        if entry == STOP:
+            raise EndOfStream()
+        nbytes, item = entry
+        if nbytes is None:
+            # a spilled item, the queue holds the file it was written to
+            with open(item, 'rb') as f:
+                spilled = pickle.load(f)
+            os.remove(item)
+            return spilled
+        with self.memory_changed:
+            self.counters[QUEUE_BYTES] -= nbytes
+            self.memory_changed.notify_all()
+        return item
+
+    def finish(self):
+        # items of a producer reach the queue in order, but not in order with other producers'
+        # items, so the last producer to finish cannot end the stream for everyone
+        self.queue.put(None)
+
+    def full(self):
+        if self.max_bytes and self.spill_path is None and self.counters[QUEUE_BYTES] >= self.max_bytes:
+            return True
+        return self.queue.full()
+
+    def memory(self):
+        return {'buffer_bytes': self.counters[QUEUE_BYTES],
+                'peak_buffer_bytes': self.counters[QUEUE_PEAK_BYTES],
+                'spilled_bytes': self.counters[QUEUE_SPILLED_BYTES]}
+
+    def __len__(self):
+        return self.queue.qsize()
+
+class SharedRingBuffer:
+    def __init__(self, n_slots=16, slot_size=4 * 1024 * 1024):
+        if n_slots < 2:
+            # the consumer keeps its last item until the next pop so one slot is always taken
+            raise ValueError('Shared ring buffer needs at least 2 slots, got', n_slots)
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+
+        self.header_shm = shared_memory.SharedMemory(create=True, size=n_slots * HEADER_FIELDS * 8)
+        self.data_shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_size)
+
+        # single producer and single consumer so every counter has exactly one writer
+        self.written = multiprocessing.RawValue('q', 0)
+        self.read = multiprocessing.RawValue('q', 0)
+        self.freed = multiprocessing.RawValue('q', 0)
+        self.free_slots = multiprocessing.Semaphore(n_slots)
+        self.used_slots = multiprocessing.Semaphore(0)
+        self.holding = False
+
+    def headers(self):
+        return np.ndarray((self.n_slots, HEADER_FIELDS), dtype=np.int64, buffer=self.header_shm.buf)
+
+    def slot(self, seq, offset, nbytes, overflow=None):
+        if overflow is not None:
+            return np.ndarray((nbytes,), dtype=np.uint8, buffer=overflow.buf, offset=offset)
+        offset += (seq % self.n_slots) * self.slot_size
+        return np.ndarray((nbytes,), dtype=np.uint8, buffer=self.data_shm.buf, offset=offset)
+
+    def overflow_name(self, seq):
+        # an item bigger than a slot gets a segment of its own, the consumer copies it out and
+        # removes the segment
+        return '{}_{}'.format(self.data_shm.name, seq)
+
+    def array_fields(self, header, i):
+        return header[ARRAYS_START + i * ARRAY_FIELDS: ARRAYS_START + (i + 1) * ARRAY_FIELDS]
+
+    def append(self, item):
+        if isinstance(item, np.ndarray):
+            kind = KIND_ARRAY
+            arrays = [item]
+        elif isinstance(item, tuple) and all(isinstance(arr, np.ndarray) for arr in item):
+            kind = KIND_TUPLE
+            arrays = list(item)
+        else:
+            kind = KIND_JSON
+            arrays = [np.frombuffer(json.dumps(item).encode(), dtype=np.uint8)]
+        self.write(kind, arrays)
+
+    def finish(self):
+        self.write(KIND_END, [])
+
+    def write(self, kind, arrays):
+        if len(arrays) > MAX_ARRAYS:
+            raise ValueError('Shared ring buffer supports up to {} arrays per item'.format(MAX_ARRAYS))
+
+        arrays = [np.ascontiguousarray(arr) for arr in arrays]
+        offsets = []
+        size = 0
+        for arr in arrays:
+            if arr.ndim > MAX_DIMS:
+                raise ValueError('Shared ring buffer supports arrays up to {} dimensions'.format(MAX_DIMS))
+            # every array starts aligned so the views handed to the consumer are aligned too
+            offset = -(-size // ALIGNMENT) * ALIGNMENT
+            offsets.append(offset)
+            size = offset + arr.nbytes
+        self.free_slots.acquire()
+        seq = self.written.value
+        overflow = None
+        if size > self.slot_size:
+            overflow = shared_memory.SharedMemory(name=self.overflow_name(seq), create=True, size=size)
+        header = self.headers()[seq % self.n_slots]
+        header[:] = 0
+        header[0] = seq
+        header[1] = kind
+        header[2] = len(arrays)
+        header[3] = overflow is not None
+        for i, (arr, offset) in enumerate(zip(arrays, offsets)):
+            self.slot(seq, offset, arr.nbytes, overflow)[:] = arr.reshape(-1).view(np.uint8)
+            fields = self.array_fields(header, i)
+            fields[0] = offset
+            fields[1] = arr.nbytes
+            fields[2] = ord(arr.dtype.char)
+            fields[3] = arr.ndim
+            fields[4: 4 + arr.ndim] = arr.shape
+        if overflow is not None:
+            overflow.close()
+
+        self.written.value = seq + 1
+        self.used_slots.release()
+
+    def pop(self, index=0):
+        if index != 0:
+            raise IndexError('Shared ring buffer can only pop the oldest item')
+        self.used_slots.acquire()
+        # the views returned by the previous pop are no longer valid
+        self.release()
+
+        seq = self.read.value
+        header = self.headers()[seq % self.n_slots]
+        if header[0] != seq:
+            raise RuntimeError('Shared ring buffer out of sync, expected item', seq, 'got', int(header[0]))
+        overflow = None
+        if header[3]:
+            overflow = shared_memory.SharedMemory(name=self.overflow_name(seq))
+        arrays = []
+        for i in range(header[2]):
+            fields = self.array_fields(header, i)
+            data = self.slot(seq, int(fields[0]), int(fields[1]), overflow)
+            shape = tuple(int(dim) for dim in fields[4: 4 + fields[3]])
+            arrays.append(data.view(np.dtype(chr(fields[2]))).reshape(shape))
+        if overflow is not None:
+            # the views into the segment are gone before it is closed
+            arrays = [arr.copy() for arr in arrays]
+            data = None
+            overflow.close()
+            overflow.unlink()
+        kind = header[1]
+        self.read.value = seq + 1
+        self.holding = True
+
+        if kind == KIND_END:
+            self.release()
+            raise EndOfStream()
+        if kind == KIND_JSON:
+            item = json.loads(arrays[0].tobytes().decode())
+            self.release()
+            return item
+        if kind == KIND_TUPLE:
+            return tuple(arrays)
+        return arrays[0]
+
+    def release(self):
+        if self.holding:
+            self.holding = False
+            self.freed.value += 1
+            self.free_slots.release()
+
+    def full(self):
+        return self.written.value - self.freed.value >= self.n_slots
+
+    def __len__(self):
+        return self.written.value - self.read.value
+
+    def close(self):
+        self.header_shm.close()
+        self.data_shm.close()
+
+    def unlink(self):
+        # overflow segments of the items that were never read
+        headers = self.headers()
+        for seq in range(self.read.value, self.written.value):
+            if headers[seq % self.n_slots][3]:
+                try:
+                    overflow = shared_memory.SharedMemory(name=self.overflow_name(seq))
+                except FileNotFoundError:
+                    continue
+                overflow.close()
+                overflow.unlink()
+        del headers
+        self.close()
+        self.header_shm.unlink()
+        self.data_shm.unlink()
@@ -0,0 +1,373 @@
+import os
+import time
+import json
+import socket
+import struct
+import selectors
+import collections
+import numpy as np
+from shared_buffer import EndOfStream, KIND_ARRAY, KIND_JSON, KIND_TUPLE, KIND_END
+
+# a frame is a header, the descriptions of its arrays and the payload with the arrays one after
+# another. header: kind, number of arrays, size of the descriptions, index of the batch (-1 when
+# the item has none) and size of the payload. An array is described by its dtype character, number
+# of dimensions and the dimensions
+HEADER = struct.Struct('<BBHqQ')
+ARRAY = struct.Struct('<BB')
+DIM = struct.Struct('<q')
+CREDIT = struct.Struct('<I') # the receiver lets the sender send that many more frames
+ALIGNMENT = 64
+KIND_RECORD = 4 # statistics of one image as a row of a structured array
+KIND_RECORDS = 5
+CONNECT_TIMEOUT = 60.0 # the other side of a connection may be started later or on another node
+
+def parse_address(address):
+    # 'unix:<path>' or 'tcp:<host>:<port>'
+    scheme, _, rest = address.partition(':')
+    if scheme == 'unix':
+        return socket.AF_UNIX, rest
+    if scheme == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return socket.AF_INET, (host, int(port))
+    raise AttributeError('Transport address not supported:', address)
+
+def pipeline_addresses(address, statistics_workers=1, statistics_hosts=None):
+    # addresses of the coordinator, of every statistics worker and of the Logger. A unix address is
+    # a directory for the sockets, a TCP one is the host of the Logger and the first of the ports
+    scheme, _, rest = address.partition(':')
+    if scheme == 'unix':
+        images = [address + '/images{}.sock'.format(i) for i in range(statistics_workers)]
+        return {'control': address + '/control.sock', 'images': images, 'stats': [address + '/stats0.sock']}
+    if scheme != 'tcp':
+        raise AttributeError('Transport address not supported:', address)
+    host, _, port = rest.rpartition(':')
+    port = int(port)
+    hosts = statistics_hosts or [host] * statistics_workers
+    images = ['tcp:{}:{}'.format(hosts[i % len(hosts)], port + 1 + i) for i in range(statistics_workers)]
+    return {'control': 'tcp:{}:{}'.format(host, port), 'images': images,
+            'stats': ['tcp:{}:{}'.format(host, port + 1 + statistics_workers)]}
+
+def listen(address, backlog=16):
+    family, location = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(location):
+            os.remove(location) # left by an earlier run
+        os.makedirs(os.path.dirname(location) or '.', exist_ok=True)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(location)
+    sock.listen(backlog)
+    return sock
+
+def accept(listener):
+    sock, _ = listener.accept()
+    if sock.family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def connect(address, timeout=CONNECT_TIMEOUT):
+    family, location = parse_address(address)
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(location)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            if time.time() > deadline:
+                raise TimeoutError('Nothing listens on', address)
+            time.sleep(0.05)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def recv_exact(sock, n):
+    data = np.empty(n, dtype=np.uint8) # aligned, so the arrays of the payload are aligned too
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError('Connection closed in the middle of a frame')
+        received += count
+    return data
+
+def payload_offsets(sizes):
+    offsets = []
+    size = 0
+    for nbytes in sizes:
+        offset = -(-size // ALIGNMENT) * ALIGNMENT
+        offsets.append(offset)
+        size = offset + nbytes
+    return offsets, size
+
+def send_frame(sock, item, records=None):
+    # records is the structured dtype and the functions converting statistics to its rows and back
+    index = -1
+    if isinstance(item, tuple) and len(item) == 2 and isinstance(item[0], int):
+        index, item = item # a batch of the ordered mode
+    if item is None:
+        kind, arrays = KIND_END, []
+    elif isinstance(item, np.ndarray):
+        kind, arrays = KIND_ARRAY, [item]
+    elif isinstance(item, tuple) and all(isinstance(arr, np.ndarray) for arr in item):
+        kind, arrays = KIND_TUPLE, list(item)
+    elif records is not None and isinstance(item, dict):
+        kind, arrays = KIND_RECORD, [records[1]([item])]
+    elif records is not None and isinstance(item, list) and all(isinstance(row, dict) for row in item):
+        kind, arrays = KIND_RECORDS, [records[1](item)]
+    else:
+        kind, arrays = KIND_JSON, [np.frombuffer(json.dumps(item).encode(), dtype=np.uint8)]
+
+    arrays = [np.ascontiguousarray(arr) for arr in arrays]
+    descriptions = b''
+    if kind not in (KIND_RECORD, KIND_RECORDS):
+        for arr in arrays:
+            descriptions += ARRAY.pack(ord(arr.dtype.char), arr.ndim)
+            descriptions += b''.join(DIM.pack(dim) for dim in arr.shape)
+    offsets, size = payload_offsets([arr.nbytes for arr in arrays])
+    sock.sendall(HEADER.pack(kind, len(arrays), len(descriptions), index, size) + descriptions)
+    sent = 0
+    for arr, offset in zip(arrays, offsets):
+        if offset > sent:
+            sock.sendall(bytes(offset - sent))
+        # the array goes straight from its memory to the socket
+        sock.sendall(memoryview(arr.reshape(-1).view(np.uint8)))
+        sent = offset + arr.nbytes
+
+def recv_frame(sock, records=None):
+    # the item and True when it was an end of the stream
+    kind, n_arrays, descriptions_size, index, size = HEADER.unpack(recv_exact(sock, HEADER.size).tobytes())
+    descriptions = recv_exact(sock, descriptions_size).tobytes()
+    payload = recv_exact(sock, size)
+    if kind == KIND_END:
+        return None, True
+    if kind in (KIND_RECORD, KIND_RECORDS):
+        rows = records[2](payload.view(records[0]))
+        item = rows[0] if kind == KIND_RECORD else rows
+    else:
+        dtypes = []
+        shapes = []
+        position = 0
+        for _ in range(n_arrays):
+            char, ndim = ARRAY.unpack_from(descriptions, position)
+            position += ARRAY.size
+            dtypes.append(np.dtype(chr(char)))
+            shapes.append(tuple(DIM.unpack_from(descriptions, position + i * DIM.size)[0] for i in range(ndim)))
+            position += ndim * DIM.size
+        sizes = [dtype.itemsize * int(np.prod(shape)) for dtype, shape in zip(dtypes, shapes)]
+        offsets, _ = payload_offsets(sizes)
+        arrays = [payload[offset: offset + nbytes].view(dtype).reshape(shape)
+                  for offset, nbytes, dtype, shape in zip(offsets, sizes, dtypes, shapes)]
+        if kind == KIND_JSON:
+            item = json.loads(arrays[0].tobytes().decode())
+        elif kind == KIND_TUPLE:
+            item = tuple(arrays)
+        else:
+            item = arrays[0]
+    return (item if index < 0 else (int(index), item)), False
+
+class SocketSender:
+    # producer end of a SocketChannel with the list interface used by the stages. It is connected
+    # to every consumer and sends each item to the next one that has credit left, so faster
+    # consumers get more of the items and a slow one holds back at most window of them
+    def __init__(self, addresses, records=None):
+        self.addresses = addresses
+        self.records = records
+        self.connections = None # connected by the stage process on its first append
+        self.credits = None
+        self.selector = None
+        self.next_idx = 0
+
+    def connect(self):
+        if self.connections is None:
+            self.connections = [connect(address) for address in self.addresses]
+            self.credits = [0] * len(self.connections)
+            self.selector = selectors.DefaultSelector()
+            for i, sock in enumerate(self.connections):
+                self.selector.register(sock, selectors.EVENT_READ, i)
+
+    def take_credits(self, timeout):
+        # reads the credits granted so far, waits at most timeout (None for as long as needed)
+        for key, _ in self.selector.select(timeout):
+            self.credits[key.data] += CREDIT.unpack(recv_exact(key.fileobj, CREDIT.size).tobytes())[0]
+
+    def append(self, item):
+        self.connect()
+        self.take_credits(0)
+        while not any(self.credits):
+            self.take_credits(None)
+        n = len(self.connections)
+        for i in range(self.next_idx, self.next_idx + n):
+            if self.credits[i % n]:
+                break
+        i %= n
+        self.credits[i] -= 1
+        self.next_idx = i + 1
+        send_frame(self.connections[i], item, self.records)
+
+    def finish(self):
+        self.connect()
+        self.selector.close()
+        for sock in self.connections:
+            send_frame(sock, None)
+            sock.shutdown(socket.SHUT_WR)
+        # closing with unread credits could reset the connection before the consumer reads the
+        # end of the stream, so the consumer closes first
+        for sock in self.connections:
+            while sock.recv(4096):
+                pass
+            sock.close()
+        self.connections = []
+
+    def full(self):
+        if self.connections is None:
+            return False
+        self.take_credits(0)
+        return not any(self.credits)
+
+    def __len__(self):
+        return 0 # the items in flight are counted by the consumers
+
+class SocketReceiver:
+    # consumer end of a SocketChannel, listens on its address for all the producers and grants each
+    # of them window frames, every popped item gives its producer one more
+    # the received items are only known to the stage process, it exports their number in its metrics
+    counted_by_stage = True
+    
+    def __init__(self, address, producers=1, window=16, records=None):
+        self.address = address
+        self.producers = producers
+        self.window = window
+        self.records = records
+        self.listener = None # bound by the stage process on its first pop
+        self.selector = None
+        self.ready = collections.deque()
+        self.connected = 0
+        self.finished = 0
+
+    def listen(self):
+        if self.listener is None:
+            self.listener = listen(self.address)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.listener, selectors.EVENT_READ)
+
+    def receive(self, timeout=None):
+        # handles the events of one select, tells whether there were any
+        events = self.selector.select(timeout)
+        for key, _ in events:
+            if key.fileobj is self.listener:
+                sock = accept(self.listener)
+                self.selector.register(sock, selectors.EVENT_READ)
+                sock.sendall(CREDIT.pack(self.window))
+                self.connected += 1
+                if self.connected == self.producers:
+                    self.selector.unregister(self.listener)
+                continue
+            item, end = recv_frame(key.fileobj, self.records)
+            if end:
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+                self.finished += 1
+            else:
+                self.ready.append((item, key.fileobj))
+        return bool(events)
+
+    def pop(self, index=0):
+        if index != 0:
+            raise IndexError('Socket receiver can only pop the oldest item')
+        self.listen()
+        while not self.ready:
+            if self.finished == self.producers:
+                self.close()
+                raise EndOfStream()
+            self.receive()
+        item, sock = self.ready.popleft()
+        # frames that already arrived are taken as well, so the length of ready is the backlog of
+        # the stage. The producers' windows bound their number
+        while self.receive(0):
+            pass
+        if sock.fileno() != -1:
+            sock.sendall(CREDIT.pack(1))
+        return item
+
+    def __len__(self):
+        return len(self.ready)
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            family, location = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(location):
+                os.remove(location)
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+class SocketChannel:
+    # connects the producers of a stage to its consumers, consumer i listens on addresses[i]
+    def __init__(self, addresses, producers=1, window=16, records=None):
+        self.addresses = addresses
+        self.producers = producers
+        self.window = window
+        self.records = records
+
+    def sender(self):
+        return SocketSender(self.addresses, self.records)
+
+    def receiver(self, i):
+        return SocketReceiver(self.addresses[i], self.producers, self.window, self.records)
+
+class CoordinatorClient:
+    # given to every stage of the sockets mode, the stage waits for the coordinator before its
+    # first task and reports its metrics after the last one
+    def __init__(self, address, name, n_stages):
+        self.address = address
+        self.name = name
+        self.n_stages = n_stages
+        self.sock = None
+
+    def register(self, proc):
+        self.sock = connect(self.address)
+        send_frame(self.sock, {'stage': self.name, 'event': 'ready', 'pid': os.getpid()})
+        recv_frame(self.sock) # the start of the run
+
+    def report(self, proc):
+        send_frame(self.sock, {'stage': self.name, 'event': 'finished', 'metrics': proc.read_metrics()})
+        self.sock.close()
+        self.sock = None
+
+class Coordinator:
+    # takes the place of the Scheduler for the sockets mode. The stages run free, it starts them
+    # together once all of them, on any node, are connected and collects their final metrics
+    def __init__(self, processes, address=None, n_stages=None):
+        client = processes[0].coordinator if processes else None
+        self.address = address or client.address
+        self.n_stages = n_stages or client.n_stages
+        self.reports = {}
+
+    def schedule(self):
+        listener = listen(self.address)
+        connections = []
+        while len(connections) < self.n_stages:
+            connections.append(accept(listener))
+        for sock in connections:
+            recv_frame(sock)
+        start = time.time()
+        for sock in connections:
+            send_frame(sock, {'event': 'start', 'time': start})
+        for sock in connections:
+            report, _ = recv_frame(sock)
+            self.reports[report['stage']] = report['metrics']
+            sock.close()
+        listener.close()
+        family, location = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            os.remove(location)
+            try:
+                os.rmdir(os.path.dirname(location)) # the stages removed their sockets already
+            except OSError:
+                pass
+        return self.reports